@@ -0,0 +1,25 @@
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+"""
+Test runner
+
+Runs the tests against settings they shouldn't share with a real deployment, for now only the
+route cache's disk tier which is turned off so cached routes aren't kept between runs.
+"""
+
+TEST_SETTINGS = {
+    "ROUTE_CACHE_PATH": "",
+}
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._test_settings = override_settings(**TEST_SETTINGS)
+        self._test_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._test_settings.disable()
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+"""
+Fake Directions server
+
+Answers Google Directions (and Distance Matrix) API requests locally so the API can be load tested (and tested)
+without calling Google. Legs between two locations always get the same made up distance (1 to 15 km, from a hash
+of their names) travelled at an average of 30 km/h, waypoints are visited nearest first as with optimize:true.
+
+Run on its own with:
+    python -m benchmarks.fake_directions --port 8001 --latency 150 --jitter 50
+then set DIRECTIONS_BASE_URL=http://127.0.0.1:8001/maps/api/directions/json
+and DISTANCE_MATRIX_BASE_URL=http://127.0.0.1:8001/maps/api/distancematrix/json
+"""
+
+AVERAGE_SPEED_KPH = 30
+
+
+def leg_distance(start, end):
+    """
+    :return: made up distance in meters between two location names, the same in both directions
+    """
+
+    a, b = sorted((start, end))
+    digest = hashlib.sha1(f"{a}|{b}".encode()).digest()
+    return 1000 + int.from_bytes(digest[:4], "big") % 14000
+
+
+def make_leg(start, end):
+    meters = 0 if start == end else leg_distance(start, end)
+    seconds = round(meters / (AVERAGE_SPEED_KPH / 3.6))
+    minutes = max(round(seconds / 60), 1)
+    return {
+        "start_address": start,
+        "end_address": end,
+        "distance": {"text": f"{meters / 1000:.1f} km" if meters >= 1000 else f"{meters} m", "value": meters},
+        "duration": {"text": f"{minutes} min{'s' if minutes != 1 else ''}", "value": seconds},
+    }
+
+
+def directions(origin, destination, waypoints):
+    """
+    :return: Directions API response body for the route
+    """
+
+    order, current, remaining = [], origin, list(range(len(waypoints)))
+    while remaining:
+        nearest = min(remaining, key=lambda i: leg_distance(current, waypoints[i]))
+        remaining.remove(nearest)
+        order.append(nearest)
+        current = waypoints[nearest]
+
+    stops = [origin, *[waypoints[i] for i in order], destination]
+    return {
+        "status": "OK",
+        "routes": [{
+            "waypoint_order": order,
+            "legs": [make_leg(start, end) for start, end in zip(stops, stops[1:])],
+        }],
+    }
+
+
+def distance_matrix(origins, destinations):
+    """
+    :return: Distance Matrix API response body with a leg from every origin to every destination
+    """
+
+    return {
+        "status": "OK",
+        "origin_addresses": origins,
+        "destination_addresses": destinations,
+        "rows": [
+            {"elements": [{"status": "OK", **make_leg(origin, destination)} for destination in destinations]}
+            for origin in origins
+        ],
+    }
+
+
+class FakeDirectionsServer(ThreadingHTTPServer):
+    """
+    Directions server answering after latency milliseconds (plus or minus up to jitter milliseconds).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, jitter=0):
+        super().__init__((host, port), DirectionsHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/maps/api/directions/json"
+
+    @property
+    def matrix_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/maps/api/distancematrix/json"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-directions", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class DirectionsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self.server._lock:
+            self.server.requests += 1
+
+        delay = self.server.latency + random.uniform(-self.server.jitter, self.server.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if url.path.endswith("/distancematrix/json"):
+            if "origins" not in params or "destinations" not in params:
+                body = {"status": "INVALID_REQUEST", "rows": []}
+            else:
+                body = distance_matrix(params["origins"].split("|"), params["destinations"].split("|"))
+        elif "origin" not in params or "destination" not in params:
+            body = {"status": "INVALID_REQUEST", "routes": []}
+        else:
+            waypoints = [waypoint for waypoint in params.get("waypoints", "").split("|")
+                         if waypoint and waypoint != "optimize:true"]
+            body = directions(params["origin"], params["destination"], waypoints)
+
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Google Directions API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds before answering")
+    parser.add_argument("--jitter", type=float, default=0, help="random milliseconds added to or taken from latency")
+    args = parser.parse_args()
+
+    server = FakeDirectionsServer(args.host, args.port, args.latency, args.jitter)
+    print(f"Fake Directions API at {server.url} and {server.matrix_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
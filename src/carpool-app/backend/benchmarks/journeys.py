@@ -0,0 +1,106 @@
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+
+"""
+User journeys
+
+Scripted sequences of API calls made the same way as the app, each call is timed and recorded by endpoint.
+"""
+
+DCU = {"name": "Dublin City University, Collins Ave Ext, Whitehall, Dublin 9", "lat": 53.3863494, "lng": -6.256591399999999}
+
+LOCATIONS = [
+    {"name": "The Spire, O'Connell Street Upper, North City, Dublin, Ireland", "lat": 53.349806, "lng": -6.2602544},
+    {"name": "The Square Tallaght, Belgard Square East, Tallaght, Dublin, Ireland", "lat": 53.2865928, "lng": -6.3717012},
+    {"name": "Swords Pavilions, Main Street, Swords, Dublin, Ireland", "lat": 53.4557, "lng": -6.2197},
+    {"name": "Blanchardstown Centre, Blanchardstown, Dublin 15, Ireland", "lat": 53.3925, "lng": -6.3926},
+    {"name": "Dundrum Town Centre, Sandyford Road, Dundrum, Dublin 16, Ireland", "lat": 53.2865, "lng": -6.2415},
+    {"name": "Malahide Castle, Malahide, Dublin, Ireland", "lat": 53.4509, "lng": -6.1544},
+    {"name": "Phibsborough Shopping Centre, Phibsborough, Dublin 7, Ireland", "lat": 53.3595, "lng": -6.2729},
+    {"name": "Clontarf Road, Clontarf, Dublin 3, Ireland", "lat": 53.3620, "lng": -6.2140},
+]
+
+
+class JourneyError(Exception):
+    pass
+
+
+class Client:
+    """
+    HTTP client for one virtual user, records the latency, status and query count (if the server sends
+    X-Query-Count) of every call with the recorder.
+    """
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.session = requests.Session()
+        self.token = None
+
+    def call(self, method, endpoint, data=None):
+        headers = {"Authorization": f"Token {self.token}"} if self.token else {}
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}/{endpoint}", json=data, headers=headers, timeout=60)
+        except requests.RequestException as error:
+            self.recorder.record(endpoint, time.perf_counter() - started, None, None)
+            raise JourneyError(f"{endpoint}: {error}")
+
+        queries = response.headers.get("X-Query-Count")
+        self.recorder.record(endpoint, time.perf_counter() - started, response.status_code,
+                             int(queries) if queries is not None else None)
+        if response.status_code >= 400:
+            raise JourneyError(f"{endpoint}: HTTP {response.status_code}")
+        return response.json() if response.content else None
+
+    def register(self, username):
+        data = self.call("POST", "register", {
+            "first_name": "Bench", "last_name": "User", "phone_no": "0871234567",
+            "username": username, "password": "benchmark", "reEnteredPassword": "benchmark",
+        })
+        if "token" not in data:
+            raise JourneyError(f"register: {data}")
+        return data
+
+    def login(self, username):
+        data = self.call("POST", "login", {"username": username, "password": "benchmark"})
+        self.token = data["token"]
+        return data
+
+
+def full_journey(base_url, recorder, name, rng=random):
+    """
+    A driver offers a trip to DCU, a passenger searches for it, is added and leaves, then the driver ends the trip:
+    register -> login -> create_driver -> create_trip -> get_trips -> add_passenger_to_trip
+    -> passenger_leave_trip -> end_trip
+    """
+
+    driver, passenger = Client(base_url, recorder), Client(base_url, recorder)
+    driver.register(f"{name}d")
+    driver.login(f"{name}d")
+    passenger_user = passenger.register(f"{name}p")
+    passenger.login(f"{name}p")
+
+    driver.call("POST", "create_driver", {"make": "Make", "model": "Model", "colour": "Red", "license_plate": name[-20:]})
+
+    start, passenger_start = rng.sample(LOCATIONS, 2)
+    departure = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(hours=1)
+    trip = driver.call("POST", "create_trip", {
+        "start": start, "destination": DCU, "waypoints": {}, "passengers": {}, "available_seats": 3,
+        "duration": "20 mins", "distance": "8.0 km",
+        "time_of_departure": departure.isoformat(), "ETA": (departure + timedelta(minutes=20)).isoformat(),
+    })
+
+    passenger.call("POST", "get_trips", {
+        "start": passenger_start, "destination": DCU, "time_of_departure": departure.isoformat(), "isPassengerToDCU": True,
+    })
+    driver.call("POST", "add_passenger_to_trip", {
+        "tripID": trip["tripID"],
+        "passengerData": {"id": str(passenger_user["id"]), "passengerStart": passenger_start, "passengerDestination": DCU},
+    })
+    passenger.call("GET", "passenger_leave_trip")
+    driver.call("POST", "end_trip", {"tripID": trip["tripID"]})
@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import numpy as np
+
+from .fake_directions import FakeDirectionsServer
+from .journeys import JourneyError, full_journey
+
+
+"""
+Load driver
+
+Runs scripted user journeys (see journeys.py) from many concurrent virtual users and reports throughput and
+p50/p95/p99 latency by endpoint, queries per request and the memory high-water mark, written as JSON so runs can be
+compared across commits.
+
+By default the API is run in this process against a fresh SQLite database, with Directions answered by the fake
+Directions server, so queries per request can be counted and memory includes the server:
+    python -m benchmarks.load --users 20 --iterations 10 --latency 150
+
+--url runs the journeys against a server that is already running instead (queries per request are only reported
+if it sends X-Query-Count).
+"""
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+class Recorder:
+    """
+    Thread safe record of every API call made during a run.
+    """
+
+    def __init__(self):
+        self.calls = {}  # endpoint -> list of (seconds, status, queries)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status, queries):
+        with self._lock:
+            self.calls.setdefault(endpoint, []).append((seconds, status, queries))
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint, calls in sorted(self.calls.items()):
+            latencies = np.array([seconds for seconds, status, queries in calls]) * 1000
+            queries = [queries for seconds, status, queries in calls if queries is not None]
+            endpoints[endpoint] = {
+                "requests": len(calls),
+                "errors": sum(1 for seconds, status, queries in calls if status is None or status >= 400),
+                "throughput": len(calls) / elapsed,
+                "latency_ms": {
+                    "mean": float(latencies.mean()),
+                    "p50": float(np.percentile(latencies, 50)),
+                    "p95": float(np.percentile(latencies, 95)),
+                    "p99": float(np.percentile(latencies, 99)),
+                    "max": float(latencies.max()),
+                },
+                "queries": {"mean": float(np.mean(queries)), "max": max(queries)} if queries else None,
+            }
+        return endpoints
+
+
+class QueryCountingApp:
+    """
+    WSGI middleware sending the number of database queries each request made in an X-Query-Count header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        from django.db import connection
+
+        count = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal count
+            count += 1
+            return execute(sql, params, many, context)
+
+        def counting_start_response(status, headers, exc_info=None):
+            return start_response(status, [*headers, ("X-Query-Count", str(count))], exc_info)
+
+        with connection.execute_wrapper(counter):
+            return self.app(environ, counting_start_response)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_local_api(directions_url, matrix_url, database_path):
+    """
+    Sets up Django against a fresh database and serves the API from a background thread.
+
+    :return: the API's base url
+    """
+
+    os.environ.update({
+        "DJANGO_SETTINGS_MODULE": "backend.settings",
+        "DIRECTIONS_BASE_URL": directions_url,
+        "DISTANCE_MATRIX_BASE_URL": matrix_url,
+        "GOOGLE_API_KEY": "benchmark",
+        "ROUTING_PROVIDER": "carpool.routing.GoogleDirectionsProvider",
+        "DATABASE_URL": f"sqlite:///{database_path}",
+        "DATABASE_READ_URL": "",
+        # every request runs on a new thread, so connections can't be reused between requests
+        "DB_CONN_MAX_AGE": "0",
+        "ROUTE_CACHE_PATH": "",
+    })
+    sys.path.insert(0, str(BACKEND_DIR))
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.core.wsgi import get_wsgi_application
+
+    call_command("migrate", run_syncdb=True, verbosity=0)
+    server = make_server("127.0.0.1", 0, QueryCountingApp(get_wsgi_application()),
+                         server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="api", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(users, iterations, url=None, latency=0, jitter=0, seed=0):
+    """
+    Runs iterations journeys for each of users concurrent virtual users.
+
+    :return: dict of results
+    """
+
+    directions = FakeDirectionsServer(latency=latency, jitter=jitter).start() if url is None else None
+    database_dir = tempfile.TemporaryDirectory() if url is None else None
+    try:
+        if url is None:
+            url = start_local_api(directions.url, directions.matrix_url, Path(database_dir.name) / "benchmark.sqlite3")
+
+        recorder = Recorder()
+        failures = []
+        run_id = f"{int(time.time()) % 100000}"
+        memory_before = max_rss_mb()
+
+        def virtual_user(user):
+            rng = random.Random(f"{seed}-{user}")
+            for iteration in range(iterations):
+                try:
+                    full_journey(url, recorder, f"b{run_id}u{user}i{iteration}", rng)
+                except JourneyError as error:
+                    failures.append(str(error))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=users) as pool:
+            list(pool.map(virtual_user, range(users)))
+        elapsed = time.perf_counter() - started
+
+        endpoints = recorder.summary(elapsed)
+        total_requests = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "config": {"users": users, "iterations": iterations, "url": url if directions is None else "local",
+                       "directions_latency_ms": latency, "directions_jitter_ms": jitter, "seed": seed},
+            "elapsed_s": elapsed,
+            "journeys": users * iterations,
+            "failed_journeys": len(failures),
+            "failures": failures[:20],
+            "requests": total_requests,
+            "throughput": total_requests / elapsed,
+            "directions_requests": directions.requests if directions is not None else None,
+            "memory_mb": {"before": memory_before, "high_water": max_rss_mb()},
+            "endpoints": endpoints,
+        }
+    finally:
+        if directions is not None:
+            directions.stop()
+        if database_dir is not None:
+            database_dir.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the carpool API with scripted user journeys.")
+    parser.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=5, help="journeys per virtual user")
+    parser.add_argument("--url", help="base url of a running API, by default one is run in this process")
+    parser.add_argument("--latency", type=float, default=100, help="fake Directions latency in milliseconds")
+    parser.add_argument("--jitter", type=float, default=25, help="fake Directions latency jitter in milliseconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file, by default benchmarks/results/<time>-<commit>.json")
+    args = parser.parse_args()
+
+    results = run(args.users, args.iterations, args.url, args.latency, args.jitter, args.seed)
+
+    output = Path(args.output) if args.output else \
+        RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}-{(results['commit'] or 'unknown')[:8]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+
+    print(f"{results['journeys']} journeys ({results['failed_journeys']} failed), "
+          f"{results['requests']} requests in {results['elapsed_s']:.1f}s, {results['throughput']:.1f} req/s")
+    print(f"{'endpoint':<24}{'req':>6}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}")
+    for endpoint, stats in results["endpoints"].items():
+        latency = stats["latency_ms"]
+        queries = f"{stats['queries']['mean']:.1f}" if stats["queries"] else "-"
+        print(f"{endpoint:<24}{stats['requests']:>6}{stats['errors']:>5}"
+              f"{latency['p50']:>9.1f}{latency['p95']:>9.1f}{latency['p99']:>9.1f}{queries:>9}")
+    print(f"memory high water {results['memory_mb']['high_water']:.0f} MB, results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CarpoolConfig(AppConfig):
     name = 'carpool'
+
+    def ready(self):
+        # connects the signals that keep the token cache up to date
+        from . import authentication
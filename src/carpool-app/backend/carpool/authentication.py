@@ -0,0 +1,196 @@
+import copy
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import CarpoolUser
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Token authentication cache
+
+Keeps the user of recently used tokens in memory so authenticating a request costs no queries.
+Cached users are dropped as soon as they are saved or deleted, or their token is deleted (logout),
+in this process. Writes that skip signals (QuerySet.update, e.g. in trips.py) call invalidate_users themselves.
+
+If TRIP_EVENTS_REDIS_URL is set invalidations are also published through Redis, the same as trip events
+(see events.py), and every worker process drops the users and tokens it is told about. Without it other worker
+processes only see a change once their entry expires, which is why TOKEN_CACHE_TTL is kept short.
+"""
+
+INVALIDATION_CHANNEL = "carpool:token_invalidations"
+
+
+class TokenCache:
+    """
+    Bounded LRU of token key to user with a TTL.
+    """
+
+    def __init__(self, max_entries=4096, ttl=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # token key -> (user, expires)
+        self._keys = {}  # user id -> token keys of that user in the cache
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: a copy of the cached user, so changes made while handling a request don't leak into the cache,
+        or None if the token isn't cached
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return copy.copy(user)
+
+    def set(self, key, user):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (copy.copy(user), time.monotonic() + self.ttl)
+            self._keys.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_key(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_users(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                for key in list(self._keys.get(user_id, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._keys.get(entry[0].pk)
+            keys.discard(key)
+            if not keys:
+                del self._keys[entry[0].pk]
+
+
+class TokenInvalidations:
+    """
+    Passes token cache invalidations on to every worker process through Redis.
+    """
+
+    def __init__(self, cache, redis_url=None):
+        self.cache = cache
+        self.redis_url = redis_url
+        self._redis = None
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def publish(self, user_ids=(), keys=()):
+        """
+        Drops the users and token keys from this process's cache and, with Redis, every other process's.
+        """
+
+        message = {"users": list(user_ids), "keys": list(keys)}
+        self.apply(message)
+        if self.redis_url:
+            self._redis_client().publish(INVALIDATION_CHANNEL, json.dumps(message))
+
+    def apply(self, message):
+        self.cache.invalidate_users(message.get("users", ()))
+        for key in message.get("keys", ()):
+            self.cache.invalidate_key(key)
+
+    def start_listener(self):
+        # only processes that cache users need to hear about changes to them
+        if not self.redis_url:
+            return
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(target=self._listen, name="token-invalidations", daemon=True)
+        self._listener.start()
+
+    def _redis_client(self):
+        if self._redis is None:
+            import redis  # only needed for invalidating across workers
+            self._redis = redis.Redis.from_url(self.redis_url)
+        return self._redis
+
+    def _listen(self):
+        pubsub = self._redis_client().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(INVALIDATION_CHANNEL)
+        for message in pubsub.listen():
+            try:
+                self.apply(json.loads(message["data"]))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                logger.warning("Ignoring malformed token invalidation %r", message["data"])
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_MAX_ENTRIES, settings.TOKEN_CACHE_TTL)
+invalidations = TokenInvalidations(token_cache, settings.TRIP_EVENTS_REDIS_URL)
+
+
+def invalidate_users(user_ids):
+    """
+    Drops users from the token cache, now and again (in every process) once the current transaction commits
+    so a request that read the user before the commit can't leave the old user cached.
+    """
+
+    user_ids = list(user_ids)
+    token_cache.invalidate_users(user_ids)
+    transaction.on_commit(lambda: invalidations.publish(user_ids=user_ids))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that only queries the database for tokens not in token_cache.
+    """
+
+    def authenticate_credentials(self, key):
+        user = token_cache.get(key)
+        if user is not None:
+            # request.auth is a Token the same as TokenAuthentication's, built without a query
+            return user, Token(key=key, user=user)
+
+        user, token = super().authenticate_credentials(key)
+        if token_cache.ttl > 0:
+            invalidations.start_listener()
+        token_cache.set(key, user)
+        return user, token
+
+
+@receiver(post_save, sender=CarpoolUser)
+@receiver(post_delete, sender=CarpoolUser)
+def invalidate_user(sender, instance, **kwargs):
+    invalidate_users([instance.pk])
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.invalidate_key(instance.key)
+    transaction.on_commit(lambda: invalidations.publish(keys=[instance.key]))
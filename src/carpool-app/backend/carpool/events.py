@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Trip events
+
+In-process pub/sub of trip changes streamed to the app by the trip_events view, so drivers and passengers
+get one push per change instead of polling join_trip.
+
+Events are dicts with a "type" of "passenger_joined", "passenger_left", "eta", "trip_ended" or "trip_removed"
+and the "trip" id they are about. Subscribers are asyncio queues, events are handed to their event loop
+so they can be published from any thread.
+
+If TRIP_EVENTS_REDIS_URL is set events are published through Redis instead, and every worker process
+passes the events it receives on to its own subscribers, so a subscriber gets events from changes made by any worker.
+"""
+
+REDIS_CHANNEL = "carpool:trip_events"
+
+
+class TripEventBus:
+    def __init__(self, redis_url=None):
+        self.redis_url = redis_url
+        self._subscribers = {}  # trip id -> set of (loop, queue)
+        self._lock = threading.Lock()
+        self._redis = None
+        self._listener = None
+
+    def subscribe(self, trip_id, loop, queue):
+        with self._lock:
+            self._subscribers.setdefault(int(trip_id), set()).add((loop, queue))
+        if self.redis_url:
+            self._start_listener()
+
+    def unsubscribe(self, trip_id, loop, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(int(trip_id), set())
+            subscribers.discard((loop, queue))
+            if not subscribers:
+                self._subscribers.pop(int(trip_id), None)
+
+    def subscriber_count(self, trip_id):
+        with self._lock:
+            return len(self._subscribers.get(int(trip_id), ()))
+
+    def publish(self, event):
+        if self.redis_url:
+            self._redis_client().publish(REDIS_CHANNEL, json.dumps(event, cls=DjangoJSONEncoder))
+        else:
+            self.deliver(event)
+
+    def deliver(self, event):
+        """
+        Passes an event to the subscribers of its trip in this process.
+        """
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(int(event["trip"]), ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:  # the subscriber's event loop has closed
+                self.unsubscribe(event["trip"], loop, queue)
+
+    def _redis_client(self):
+        if self._redis is None:
+            import redis  # only needed for fan out across workers
+            self._redis = redis.Redis.from_url(self.redis_url)
+        return self._redis
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(target=self._listen, name="trip-events", daemon=True)
+        self._listener.start()
+
+    def _listen(self):
+        pubsub = self._redis_client().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(REDIS_CHANNEL)
+        for message in pubsub.listen():
+            try:
+                self.deliver(json.loads(message["data"]))
+            except (ValueError, KeyError, TypeError):
+                logger.warning("Ignoring malformed trip event %r", message["data"])
+
+
+event_bus = TripEventBus(settings.TRIP_EVENTS_REDIS_URL)
+
+
+def publish_trip_event(trip_id, event_type, **data):
+    """
+    Publishes a trip event once the current transaction commits, so subscribers never see a change that was rolled back.
+    """
+
+    event = {"type": event_type, "trip": int(trip_id), **data}
+    transaction.on_commit(lambda: event_bus.publish(event))
+
+
+async def stream_trip_events(trip_id):
+    """
+    Server-Sent Events stream of a trip's events, ending after the trip is ended or removed.
+    """
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    event_bus.subscribe(trip_id, loop, queue)
+    try:
+        yield f"event: connected\ndata: {json.dumps({'trip': int(trip_id)})}\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), settings.TRIP_EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                # stops proxies closing the connection while nothing is happening
+                yield ": keepalive\n\n"
+                continue
+
+            yield f"event: {event['type']}\ndata: {json.dumps(event, cls=DjangoJSONEncoder)}\n\n"
+            if event["type"] in ("trip_ended", "trip_removed"):
+                break
+    finally:
+        event_bus.unsubscribe(trip_id, loop, queue)
@@ -0,0 +1,136 @@
+import numpy as np
+
+
+"""
+Geometry helpers
+
+Straight line distance estimates using the lat/lng already stored on trip locations,
+used to rule out trips before any routing requests are made.
+"""
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in km between points given in degrees, works on numpy arrays element-wise.
+    """
+
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def location_point(location):
+    """
+    :return: (lat, lng) of a location dict, or None if it has no coordinates
+    """
+
+    try:
+        return float(location["lat"]), float(location["lng"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def trip_stops(trip):
+    """
+    :return: list of (lat, lng) for the trip start, waypoints and destination, or None if the start or destination
+    have no coordinates. Waypoints without coordinates are left out.
+    """
+
+    start = location_point(trip.start)
+    destination = location_point(trip.destination)
+    if start is None or destination is None:
+        return None
+
+    waypoints = [location_point(waypoint) for waypoint in trip.waypoints.values()]
+    return [start, *[point for point in waypoints if point is not None], destination]
+
+
+def estimate_detours(trips, lat, lng):
+    """
+    Estimates the extra distance (km) each trip would have to travel to stop at (lat, lng).
+
+    The passenger is inserted between every pair of the trip's stops and the cheapest insertion is used,
+    since the order waypoints are visited in isn't known without routing,
+    this makes the estimate a lower bound of the detour needed for any waypoint order.
+    All trips are computed at once, stops are padded with the trip destination so every trip has the same number.
+
+    :return: numpy array with the detour of each trip, nan for trips without coordinates
+    """
+
+    detours = np.full(len(trips), np.nan)
+    known, points = padded_stops(trips)
+    if not known:
+        return detours
+
+    lats, lngs = points[:, :, 0], points[:, :, 1]
+
+    to_passenger = haversine(lats, lngs, lat, lng)  # (trips, stops)
+    between_stops = haversine(lats[:, :, None], lngs[:, :, None], lats[:, None, :], lngs[:, None, :])  # (trips, stops, stops)
+
+    insertion = to_passenger[:, :, None] + to_passenger[:, None, :] - between_stops
+    detours[known] = insertion.reshape(len(known), -1).min(axis=1)
+    return detours
+
+
+def padded_stops(trips):
+    """
+    :return: (indexes of the trips with coordinates, numpy array (trips, stops, 2) of their stops' lat/lng
+    padded with the trip destination so every trip has the same number)
+    """
+
+    stops = [trip_stops(trip) for trip in trips]
+    known = [i for i, trip_stop in enumerate(stops) if trip_stop is not None]
+    if not known:
+        return known, np.empty((0, 0, 2))
+
+    max_stops = max(len(stops[i]) for i in known)
+    return known, np.array([stops[i] + [stops[i][-1]] * (max_stops - len(stops[i])) for i in known])
+
+
+def detour_matrix(trips, points, chunk_size=256):
+    """
+    Estimates the extra distance (km) every trip would have to travel to stop at every point, the same way
+    as estimate_detours. Points are done chunk_size at a time so memory stays at (trips, stops, chunk_size).
+
+    :param points: numpy array (points, 2) of lat/lng
+    :return: numpy array (trips, points) of detours, nan for trips or points without coordinates
+    """
+
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    detours = np.full((len(trips), len(points)), np.nan)
+    known, stops = padded_stops(trips)
+    if not known or not len(points):
+        return detours
+
+    lats, lngs = stops[:, :, 0, None], stops[:, :, 1, None]
+    between_stops = haversine(lats, lngs, stops[:, None, :, 0], stops[:, None, :, 1])  # (trips, stops, stops)
+    for first in range(0, len(points), chunk_size):
+        chunk = points[first:first + chunk_size]
+        to_points = haversine(lats, lngs, chunk[:, 0], chunk[:, 1])  # (trips, stops, points)
+        best = np.full((len(known), len(chunk)), np.inf)
+        # between_stops is symmetric, so (i, j) and (j, i) are the same insertion
+        for i in range(stops.shape[1]):
+            for j in range(i, stops.shape[1]):
+                np.fmin(best, to_points[:, i] + to_points[:, j] - between_stops[:, i, j, None], out=best)
+        best[np.isinf(best)] = np.nan
+        detours[known, first:first + chunk_size] = best
+    return detours
+
+
+def via_distances(trips, lat, lng):
+    """
+    Straight line distance (km) from each trip's start to (lat, lng) then on to the trip's destination.
+    Any route from the start to the destination stopping at (lat, lng) is at least this long.
+
+    :return: numpy array of distances, nan for trips without coordinates
+    """
+
+    points = np.full((len(trips), 4), np.nan)
+    for i, trip in enumerate(trips):
+        start, destination = location_point(trip.start), location_point(trip.destination)
+        if start is not None and destination is not None:
+            points[i] = (*start, *destination)
+
+    return haversine(points[:, 0], points[:, 1], lat, lng) + haversine(lat, lng, points[:, 2], points[:, 3])
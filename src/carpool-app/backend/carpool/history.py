@@ -0,0 +1,77 @@
+import json
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import CarpoolUser, Trip, TripHistory
+from .serializers import ALL_TRIP_FIELDS, trip_fields
+
+
+"""
+Trip history
+
+Ended trips are moved out of the Trip table, which every search scans, into TripHistory by the compact_trips command.
+A TripHistory row keeps the columns needed to find a trip (driver, campus, times, totals) and a zlib compressed
+JSON snapshot of everything else, the trip's passengers, waypoints and route included.
+Trips are moved in batches of TRIP_COMPACTION_BATCH, each batch in one transaction, so Trip only holds live trips
+and ones that ended in the last TRIP_COMPACTION_DELAY minutes.
+"""
+
+
+def trip_snapshot(trip):
+    """
+    :return: all the trip's fields (see serializers.trip_fields) as zlib compressed JSON, see TripHistory.to_json
+    """
+
+    return zlib.compress(json.dumps({"id": trip.pk, **trip_fields(trip, ALL_TRIP_FIELDS)}, separators=(",", ":")).encode(), 9)
+
+
+def history_row(trip):
+    return TripHistory(
+        id=trip.pk, driver=trip.driver_id, time_of_departure=trip.time_of_departure,
+        # trips ended before ended_at existed are taken to have ended when they arrived
+        ended_at=trip.ended_at or trip.ETA, to_campus=trip.to_campus, campus=trip.campus,
+        distance_m=trip.distance_m, duration_s=trip.duration_s, passenger_count=len(trip.trip_passengers.all()),
+        snapshot=trip_snapshot(trip),
+    )
+
+
+def ended_trips(before):
+    """
+    :return: queryset of the trips that ended before `before` with nobody still in them.
+    Inactive trips without an ended_at (ended before it existed) count as ended if they left before `before`.
+    """
+
+    return Trip.objects.filter(
+        Q(ended_at__lt=before) | Q(ended_at=None, is_active=False, time_of_departure__lt=before)
+    ).filter(~Exists(CarpoolUser.objects.filter(current_trip=OuterRef("pk"))))
+
+
+def compact_trips(before=None, batch_size=None):
+    """
+    Moves ended trips to TripHistory and deletes them (with their passengers, waypoints and queued route) from Trip.
+
+    :param before: only trips that ended before this are moved, TRIP_COMPACTION_DELAY minutes ago by default
+    :return: number of trips moved
+    """
+
+    before = before or timezone.now() - timedelta(minutes=settings.TRIP_COMPACTION_DELAY)
+    batch_size = batch_size or settings.TRIP_COMPACTION_BATCH
+
+    moved = 0
+    while True:
+        with transaction.atomic():
+            trip_ids = list(ended_trips(before).select_for_update().order_by("id")
+                            .values_list("id", flat=True)[:batch_size])
+            if not trip_ids:
+                return moved
+
+            trips = Trip.objects.filter(id__in=trip_ids).select_related("driver_id") \
+                .prefetch_related("trip_passengers", "trip_waypoints")
+            TripHistory.objects.bulk_create([history_row(trip) for trip in trips])
+            Trip.objects.filter(id__in=trip_ids).delete()
+        moved += len(trip_ids)
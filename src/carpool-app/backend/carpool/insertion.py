@@ -0,0 +1,120 @@
+import contextvars
+import copy
+from concurrent.futures import wait
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+
+from .route import Route, RouteLeg, format_trip_distance, format_trip_duration
+from .routing import RoutingError, executor, get_travel_matrix
+
+
+"""
+Insertion estimates
+
+Estimates the ETA every candidate trip of a search would have with the passenger added, from travel times between
+the passenger and the stops of every trip got in one batch (see RoutingProvider.travel_matrix) instead of
+a Directions request per trip. The passenger's stop goes into whichever leg of the trip's stored route it adds
+the least time to (cheapest insertion) and the rest of the route is kept as it is, full directions are only fetched
+for the trip the passenger joins.
+"""
+
+
+def trip_legs(trip):
+    """
+    :return: (the trip's stops as location dicts in the order they are visited, (duration, distance) of each leg
+    between them), or None if the order of the trip's waypoints isn't known because its stored route
+    doesn't include all of them (e.g. the route is still queued)
+    """
+
+    legs = Route.from_json(trip.route).legs
+    waypoints = list(trip.waypoints.values())
+    if not legs:
+        if waypoints:
+            return None
+        return [trip.start, trip.destination], [(trip.duration_s, trip.distance_m)]
+
+    names = [legs[0].start, *[leg.destination for leg in legs]]
+    if not {waypoint["name"] for waypoint in waypoints} <= set(names):
+        return None
+
+    locations = {location["name"]: location for location in (trip.start, *waypoints, trip.destination)}
+    return [locations.get(name, {"name": name}) for name in names], [(leg.duration, leg.distance) for leg in legs]
+
+
+def estimate_insertions(trips, location, timeout=None):
+    """
+    Estimates each trip's route with a stop at location added,
+    with one travel matrix request to location from every stop and one from location to every stop,
+    made concurrently on the routing thread pool.
+
+    :param timeout: seconds to wait for both requests, TRIP_SEARCH_DEADLINE by default,
+    a RoutingError is raised if they haven't finished by then
+
+    :return: dict of trip id to a copy of the trip with the estimated route, ETA, duration and distance.
+    Trips that can't be estimated (see trip_legs, or with no route between location and their stops) are left out.
+    """
+
+    trip_stops = [(trip, *legs) for trip, legs in ((trip, trip_legs(trip)) for trip in trips) if legs is not None]
+    if not trip_stops:
+        return {}
+
+    stops = list({stop["name"]: stop for trip, trip_stop, legs in trip_stops for stop in trip_stop}.values())
+    stop_indexes = {stop["name"]: i for i, stop in enumerate(stops)}
+    # each request runs in a copy of the caller's context, so metrics are recorded against the caller's view
+    to_matrix, from_matrix = futures = [
+        executor.submit(contextvars.copy_context().run, get_travel_matrix, origins, destinations)
+        for origins, destinations in ((stops, [location]), ([location], stops))
+    ]
+    done, not_done = wait(futures, timeout=settings.TRIP_SEARCH_DEADLINE if timeout is None else timeout)
+    for future in not_done:
+        future.cancel()
+    if not_done:
+        raise RoutingError("Travel matrix requests did not finish before the deadline.")
+
+    to_times, to_distances = (matrix[:, 0] for matrix in to_matrix.result())
+    from_times, from_distances = (matrix[0] for matrix in from_matrix.result())
+
+    estimates = {}
+    for trip, trip_stop, legs in trip_stops:
+        indexes = np.array([stop_indexes[stop["name"]] for stop in trip_stop])
+        leg_times = np.array([duration for duration, distance in legs], dtype=float)
+        # time added by going via location instead of straight along each leg
+        added = to_times[indexes[:-1]] + from_times[indexes[1:]] - leg_times
+        if np.isnan(added).all():
+            continue
+
+        leg = int(np.nanargmin(added))
+        to_location = (to_times[indexes[leg]], to_distances[indexes[leg]])
+        from_location = (from_times[indexes[leg + 1]], from_distances[indexes[leg + 1]])
+        names = [stop["name"] for stop in trip_stop]
+        names.insert(leg + 1, location["name"])
+        estimates[trip.pk] = estimated_trip(trip, names, [*legs[:leg], to_location, from_location, *legs[leg + 1:]])
+
+    return estimates
+
+
+def estimated_trip(trip, names, legs):
+    """
+    :param names: names of the stops in the order they are visited
+    :param legs: (duration, distance) of each leg between them
+    :return: copy of the trip with the route, ETA, duration and distance of the estimate
+    """
+
+    departure_time = int(trip.time_of_departure.timestamp())
+    route = Route()
+    for start, destination, (duration, distance) in zip(names, names[1:], legs):
+        duration, distance = round(float(duration)), round(float(distance))
+        route.legs.append(RouteLeg(start, destination, distance, duration, departure_time, departure_time + duration))
+        departure_time += duration
+    route.index_passengers(trip)
+
+    estimate = copy.copy(trip)
+    estimate.distance_m = sum(leg.distance for leg in route.legs)
+    estimate.duration_s = sum(leg.duration for leg in route.legs)
+    estimate.distance = format_trip_distance(estimate.distance_m)
+    estimate.duration = format_trip_duration(estimate.duration_s)
+    estimate.ETA = (trip.time_of_departure + timedelta(seconds=estimate.duration_s)).replace(microsecond=0)
+    estimate.route = route.to_json()
+    return estimate
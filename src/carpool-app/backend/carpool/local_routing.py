@@ -0,0 +1,236 @@
+import heapq
+import itertools
+import math
+
+import numpy as np
+from django.conf import settings
+
+from .geo import haversine, location_point
+from .routing import RoutingError, RoutingProvider, format_distance, format_duration
+
+
+"""
+Local routing
+
+Answers directions in-process from a preprocessed road graph instead of calling the Directions API.
+The graph is stored as a compressed .npz file (see build_road_graph) holding a CSR adjacency list:
+
+    lat, lng        float32 coordinates of each node
+    indptr          int32, edges leaving node i are indptr[i]:indptr[i + 1]
+    indices         int32 node each edge goes to
+    length          float32 edge length in meters
+    time            float32 edge travel time in seconds
+"""
+
+GRAPH_ARRAYS = ("lat", "lng", "indptr", "indices", "length", "time")
+
+# brute force the waypoint order up to this many waypoints (7! orders), after that nearest neighbour is used.
+MAX_PERMUTED_WAYPOINTS = 7
+
+
+def save_graph(path, lat, lng, indptr, indices, length, time):
+    np.savez_compressed(
+        path,
+        lat=np.asarray(lat, dtype=np.float32), lng=np.asarray(lng, dtype=np.float32),
+        indptr=np.asarray(indptr, dtype=np.int32), indices=np.asarray(indices, dtype=np.int32),
+        length=np.asarray(length, dtype=np.float32), time=np.asarray(time, dtype=np.float32),
+    )
+
+
+class RoadGraph:
+    """
+    Road graph loaded from a graph file with A* shortest (fastest) path queries.
+    """
+
+    def __init__(self, lat, lng, indptr, indices, length, time):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+
+        # plain lists are much faster than numpy arrays to index one element at a time in the search loop
+        self._lat = self.lat.tolist()
+        self._lng = self.lng.tolist()
+        self._indptr = np.asarray(indptr).tolist()
+        self._indices = np.asarray(indices).tolist()
+        self._length = np.asarray(length, dtype=np.float64).tolist()
+        self._time = np.asarray(time, dtype=np.float64).tolist()
+
+        # the fastest speed on any edge, so straight line distance / max_speed never overestimates the time left
+        speeds = np.asarray(length, dtype=np.float64) / np.maximum(np.asarray(time, dtype=np.float64), 1e-6)
+        self.max_speed = float(speeds.max()) if len(speeds) else 1.0
+
+        self._reversed = None
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as graph:
+            return cls(*[graph[name] for name in GRAPH_ARRAYS])
+
+    def nearest_node(self, lat, lng):
+        return int(np.argmin(haversine(self.lat, self.lng, lat, lng)))
+
+    def _heuristic(self, node, target_lat, target_lng):
+        lat1, lng1 = math.radians(self._lat[node]), math.radians(self._lng[node])
+        a = math.sin((target_lat - lat1) / 2) ** 2 + \
+            math.cos(lat1) * math.cos(target_lat) * math.sin((target_lng - lng1) / 2) ** 2
+        return 2 * 6371008.8 * math.asin(math.sqrt(a)) / self.max_speed
+
+    def shortest_path(self, source, target):
+        """
+        A* search for the fastest path from source to target.
+
+        :return: (travel time in seconds, length in meters)
+        """
+
+        if source == target:
+            return 0.0, 0.0
+
+        target_lat, target_lng = math.radians(self._lat[target]), math.radians(self._lng[target])
+        indptr, indices, lengths, times = self._indptr, self._indices, self._length, self._time
+
+        best = {source: 0.0}
+        travelled = {source: 0.0}
+        queue = [(self._heuristic(source, target_lat, target_lng), source)]
+        settled = set()
+
+        while queue:
+            _, node = heapq.heappop(queue)
+            if node == target:
+                return best[node], travelled[node]
+            if node in settled:
+                continue
+            settled.add(node)
+
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                cost = best[node] + times[edge]
+                if cost < best.get(neighbour, math.inf):
+                    best[neighbour] = cost
+                    travelled[neighbour] = travelled[node] + lengths[edge]
+                    heapq.heappush(queue, (cost + self._heuristic(neighbour, target_lat, target_lng), neighbour))
+
+        raise RoutingError(f"no path between nodes {source} and {target}")
+
+    def travel_times(self, source, targets, reverse=False):
+        """
+        Dijkstra search from source until every target is reached, for one to many queries.
+        With reverse the edges are followed backwards, giving the times from each target to source instead.
+
+        :return: (travel times in seconds, lengths in meters) numpy arrays in the same order as targets,
+        nan for targets that can't be reached
+        """
+
+        indptr, indices, lengths, times = self._reverse_edges() if reverse else \
+            (self._indptr, self._indices, self._length, self._time)
+
+        remaining = set(targets)
+        best = {source: 0.0}
+        travelled = {source: 0.0}
+        queue = [(0.0, source)]
+        settled = set()
+
+        while queue and remaining:
+            cost, node = heapq.heappop(queue)
+            if node in settled:
+                continue
+            settled.add(node)
+            remaining.discard(node)
+
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[edge]
+                neighbour_cost = cost + times[edge]
+                if neighbour_cost < best.get(neighbour, math.inf):
+                    best[neighbour] = neighbour_cost
+                    travelled[neighbour] = travelled[node] + lengths[edge]
+                    heapq.heappush(queue, (neighbour_cost, neighbour))
+
+        return (np.array([best[target] if target in settled else np.nan for target in targets]),
+                np.array([travelled[target] if target in settled else np.nan for target in targets]))
+
+    def _reverse_edges(self):
+        # CSR adjacency list of the graph with every edge reversed, built the first time it is needed
+        if self._reversed is None:
+            indptr, indices = np.asarray(self._indptr), np.asarray(self._indices)
+            sources = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            order = np.argsort(indices, kind="stable")
+            reverse_indptr = np.concatenate([[0], np.cumsum(np.bincount(indices, minlength=len(indptr) - 1))])
+            self._reversed = (reverse_indptr.tolist(), sources[order].tolist(),
+                              np.asarray(self._length)[order].tolist(), np.asarray(self._time)[order].tolist())
+        return self._reversed
+
+
+class LocalRoutingProvider(RoutingProvider):
+    """
+    Routes using the road graph at ROUTING_GRAPH_PATH, locations are snapped to their nearest graph node by lat/lng.
+    """
+
+    def __init__(self, graph=None):
+        self.graph = graph if graph is not None else RoadGraph.load(settings.ROUTING_GRAPH_PATH)
+
+    def directions(self, origin, destination, waypoints):
+        locations = [origin, *waypoints, destination]
+        nodes = self._nodes(locations)
+
+        paths = {}
+
+        def path(i, j):
+            if (i, j) not in paths:
+                paths[(i, j)] = self.graph.shortest_path(nodes[i], nodes[j])
+            return paths[(i, j)]
+
+        order = self._waypoint_order(len(waypoints), lambda i, j: path(i, j)[0])
+        stops = [0, *[i + 1 for i in order], len(locations) - 1]
+
+        legs = []
+        for i, j in zip(stops, stops[1:]):
+            duration, distance = path(i, j)
+            legs.append({
+                "start_address": locations[i]["name"],
+                "end_address": locations[j]["name"],
+                "distance": {"text": format_distance(round(distance)), "value": round(distance)},
+                "duration": {"text": format_duration(round(duration)), "value": round(duration)},
+            })
+
+        return {"waypoint_order": order, "legs": legs}
+
+    def travel_matrix(self, origins, destinations, departure_time=None):
+        # road speeds don't change through the day, so departure_time makes no difference.
+        # one search per origin, or per destination following edges backwards if there are fewer of them
+        origin_nodes, destination_nodes = self._nodes(origins), self._nodes(destinations)
+        durations = np.full((len(origins), len(destinations)), np.nan)
+        distances = np.full((len(origins), len(destinations)), np.nan)
+        if len(origins) <= len(destinations):
+            for i, node in enumerate(origin_nodes):
+                durations[i], distances[i] = self.graph.travel_times(node, destination_nodes)
+        else:
+            for j, node in enumerate(destination_nodes):
+                durations[:, j], distances[:, j] = self.graph.travel_times(node, origin_nodes, reverse=True)
+        return np.round(durations), np.round(distances)
+
+    def _nodes(self, locations):
+        points = [location_point(location) for location in locations]
+        if None in points:
+            raise RoutingError("local routing needs lat/lng for every location")
+        return [self.graph.nearest_node(*point) for point in points]
+
+    @staticmethod
+    def _waypoint_order(count, cost):
+        """
+        Finds the fastest order to visit the waypoints in, cost(i, j) is the travel time between locations i and j
+        where 0 is the origin, 1 to count are the waypoints and count + 1 is the destination.
+        """
+
+        destination = count + 1
+        if count <= MAX_PERMUTED_WAYPOINTS:
+            def total(order):
+                stops = [0, *order, destination]
+                return sum(cost(i, j) for i, j in zip(stops, stops[1:]))
+
+            best = min(itertools.permutations(range(1, count + 1)), key=total)
+        else:
+            best, current, remaining = [], 0, set(range(1, count + 1))
+            while remaining:
+                current = min(remaining, key=lambda i: cost(current, i))
+                remaining.remove(current)
+                best.append(current)
+
+        return [i - 1 for i in best]
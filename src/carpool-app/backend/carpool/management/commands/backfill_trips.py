@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from carpool.models import CarpoolUser, Trip
+from carpool.route import trip_totals
+
+
+class Command(BaseCommand):
+    """
+    Fills in columns derived from existing trip data for trips created before those columns were added.
+    Safe to run more than once.
+    """
+
+    help = "Backfills derived trip columns and passenger/waypoint rows for existing trips."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        # trips were only ever active while someone had them as their current trip
+        active_trip_ids = set(CarpoolUser.objects.exclude(current_trip=None).values_list("current_trip", flat=True))
+
+        batch = []
+        count = 0
+        for trip in Trip.objects.order_by("id").iterator(chunk_size=batch_size):
+            trip.is_active = trip.id in active_trip_ids
+            trip.update_campus()
+            trip.distance_m, trip.duration_s = trip_totals(trip)
+            batch.append(trip)
+            if len(batch) >= batch_size:
+                count += self.save_batch(batch)
+                batch = []
+        count += self.save_batch(batch)
+
+        self.stdout.write(f"Backfilled {count} trips")
+
+    def save_batch(self, trips):
+        with transaction.atomic():
+            for trip in trips:
+                # trips from before the passenger/waypoint tables, the legacy columns are cleared once moved
+                if trip.legacy_passengers or trip.legacy_waypoints:
+                    if not trip.trip_passengers.exists() and not trip.trip_waypoints.exists():
+                        trip.create_members(trip.legacy_passengers, trip.legacy_waypoints)
+                    trip.legacy_passengers = {}
+                    trip.legacy_waypoints = {}
+            Trip.objects.bulk_update(trips, ["is_active", "to_campus", "campus", "distance_m", "duration_s",
+                                             *Trip.LEGACY_FIELDS])
+        return len(trips)
@@ -0,0 +1,63 @@
+import csv
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from carpool.geo import haversine
+from carpool.local_routing import save_graph
+
+
+class Command(BaseCommand):
+    """
+    Builds the road graph file used by LocalRoutingProvider from a CSV of road segments, e.g. exported from OpenStreetMap.
+
+    CSV columns: from_lat, from_lng, to_lat, to_lng, speed_kph and optionally length_m (defaults to the straight line
+    length) and oneway (1/true/yes, defaults to two way).
+    """
+
+    help = "Builds the local routing road graph from a CSV of road segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("edges", help="CSV file of road segments")
+        parser.add_argument("output", help="graph file to write (.npz)")
+
+    def handle(self, *args, **options):
+        nodes = {}
+        edges = []
+
+        def node(lat, lng):
+            # segments sharing an end point to ~10cm share a node
+            key = (round(float(lat), 6), round(float(lng), 6))
+            return nodes.setdefault(key, len(nodes))
+
+        with open(options["edges"], newline="") as edges_file:
+            for line, row in enumerate(csv.DictReader(edges_file), start=2):
+                try:
+                    source = node(row["from_lat"], row["from_lng"])
+                    target = node(row["to_lat"], row["to_lng"])
+                    speed = float(row["speed_kph"]) / 3.6
+                    if row.get("length_m"):
+                        length = float(row["length_m"])
+                    else:
+                        length = float(haversine(float(row["from_lat"]), float(row["from_lng"]),
+                                                 float(row["to_lat"]), float(row["to_lng"]))) * 1000
+                except (KeyError, ValueError) as e:
+                    raise CommandError(f"line {line}: invalid road segment ({e})")
+
+                edges.append((source, target, length, length / speed))
+                if str(row.get("oneway", "")).lower() not in ("1", "true", "yes"):
+                    edges.append((target, source, length, length / speed))
+
+        if not edges:
+            raise CommandError("no road segments found")
+
+        coordinates = np.array(list(nodes.keys()))
+        edges = np.array(edges)
+        edges = edges[np.argsort(edges[:, 0], kind="stable")]
+        sources = edges[:, 0].astype(np.int32)
+        indptr = np.searchsorted(sources, np.arange(len(nodes) + 1))
+
+        save_graph(options["output"], coordinates[:, 0], coordinates[:, 1], indptr,
+                   edges[:, 1].astype(np.int32), edges[:, 2], edges[:, 3])
+
+        self.stdout.write(f"Wrote road graph with {len(nodes)} nodes and {len(edges)} edges to {options['output']}")
@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from carpool.routing import get_travel_matrix
+from carpool.travel_table import CAMPUS_LOCATIONS, FROM_CAMPUS, TO_CAMPUS, TravelTable
+
+
+class Command(BaseCommand):
+    """
+    Builds the campus travel time table used by trip searches (see travel_table.py) from the routing provider,
+    with a travel matrix request from every grid cell to each campus and one from each campus to every cell.
+
+    With --slices a slice is built for each hour given, from travel times departing at that hour tomorrow,
+    otherwise there is one slice for the whole day.
+    """
+
+    help = "Builds the table of travel times to and from each DCU campus."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=settings.TRAVEL_TABLE_PATH, help="table file to write (.npy)")
+        parser.add_argument("--bounds", default="53.20,-6.50,53.50,-6.05",
+                            help="south,west,north,east of the area covered, Greater Dublin by default")
+        parser.add_argument("--cell-m", type=float, default=500, help="grid cell size in meters")
+        parser.add_argument("--slices", help="comma separated hours of the day each time slice starts at, e.g. 0,7,10,16,19")
+
+    def handle(self, *args, **options):
+        try:
+            south, west, north, east = (float(value) for value in options["bounds"].split(","))
+            hours = sorted(int(hour) for hour in options["slices"].split(",")) if options["slices"] else None
+        except ValueError:
+            raise CommandError("--bounds must be 4 numbers and --slices whole hours")
+        if south >= north or west >= east or options["cell_m"] <= 0:
+            raise CommandError("invalid bounds or cell size")
+
+        table = TravelTable.empty(list(CAMPUS_LOCATIONS), south, west, north, east, options["cell_m"], hours or [0])
+        rows, cols = table.shape
+        cells = table.cell_locations()
+        # cells are sent in chunks the routing thread pool can request within DIRECTIONS_TIMEOUT
+        chunk_size = 25 * max(settings.ROUTING_MAX_WORKERS, 1)
+
+        tomorrow = timezone.localtime() + timedelta(days=1)
+        for campus_index, campus in enumerate(table.campuses):
+            location = CAMPUS_LOCATIONS[campus]
+            for slice_index, hour in enumerate(table.slices):
+                departure_time = tomorrow.replace(hour=hour, minute=0, second=0, microsecond=0) if hours else None
+                to_campus, from_campus = table.times[campus_index, TO_CAMPUS, slice_index], \
+                    table.times[campus_index, FROM_CAMPUS, slice_index]
+                for i in range(0, len(cells), chunk_size):
+                    chunk = cells[i:i + chunk_size]
+                    to_campus.flat[i:i + len(chunk)] = get_travel_matrix(chunk, [location], departure_time)[0][:, 0]
+                    from_campus.flat[i:i + len(chunk)] = get_travel_matrix([location], chunk, departure_time)[0][0]
+
+                self.stdout.write(f"{campus} from {hour}:00: {int((~np.isnan(to_campus)).sum())} of {rows * cols} "
+                                  "cells routed")
+
+        table.save(options["output"])
+        self.stdout.write(f"Wrote {rows}x{cols} travel table for {len(table.campuses)} campuses "
+                          f"and {len(table.slices)} time slices to {options['output']}")
@@ -0,0 +1,35 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from carpool.history import compact_trips
+
+
+class Command(BaseCommand):
+    """
+    Moves ended trips out of the Trip table into TripHistory (see history.py), meant to be run on a schedule,
+    or left running with --interval.
+    """
+
+    help = "Moves ended trips to the trip history."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=float,
+                            help="Only move trips that ended this many minutes ago, TRIP_COMPACTION_DELAY by default.")
+        parser.add_argument("--batch-size", type=int, help="Trips moved per transaction, TRIP_COMPACTION_BATCH by default.")
+        parser.add_argument("--interval", type=float, help="Keep compacting every this many seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            before = None
+            if options["older_than"] is not None:
+                before = timezone.now() - timedelta(minutes=options["older_than"])
+
+            started = time.perf_counter()
+            moved = compact_trips(before, options["batch_size"])
+            self.stdout.write(f"Moved {moved} ended trips to the trip history in {time.perf_counter() - started:.2f}s")
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
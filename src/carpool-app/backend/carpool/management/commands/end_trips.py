@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from carpool.models import DCU_CAMPUSES, Trip
+from carpool.trips import end_trips
+
+
+class Command(BaseCommand):
+    """
+    Ends many active trips at once, e.g. after a campus event.
+    Trips are ended in batches, each batch in one transaction with a fixed number of queries.
+    """
+
+    help = "Ends active trips by id, by campus, or all of them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("trip_ids", nargs="*", type=int)
+        parser.add_argument("--campus", choices=DCU_CAMPUSES.keys())
+        parser.add_argument("--all-active", action="store_true")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not (options["trip_ids"] or options["campus"] or options["all_active"]):
+            raise CommandError("Give trip ids, --campus or --all-active.")
+
+        trips = Trip.objects.filter(is_active=True)
+        if options["trip_ids"]:
+            trips = trips.filter(id__in=options["trip_ids"])
+        if options["campus"]:
+            trips = trips.filter(campus=options["campus"])
+
+        trip_ids = list(trips.order_by("id").values_list("id", flat=True))
+        batch_size = options["batch_size"]
+        users = 0
+        for i in range(0, len(trip_ids), batch_size):
+            users += len(end_trips(trip_ids[i:i + batch_size]))
+
+        self.stdout.write(f"Ended {len(trip_ids)} trips, {users} users set to available")
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from carpool.onboarding import FORMATS, file_format, import_users, read_users
+
+
+class Command(BaseCommand):
+    """
+    Registers a cohort of users from a CSV or JSONL file, see onboarding.py.
+    Rows that fail the /register checks are skipped and reported.
+    """
+
+    help = "Registers users from a CSV (with a header row) or JSONL file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=FORMATS, help="by default taken from the file extension")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, help="password hashing processes, by default one per CPU")
+        parser.add_argument("--report", help="write the errors of skipped rows to this file as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            with open(options["path"], newline="", encoding="utf-8-sig") as file:
+                rows = read_users(file, file_format(options["path"], options["format"]))
+        except (OSError, ValueError) as error:
+            raise CommandError(str(error))
+
+        result = import_users(rows, options["batch_size"], options["workers"])
+
+        if options["report"]:
+            with open(options["report"], "w") as report:
+                json.dump(result["errors"], report, indent=2)
+        for error in result["errors"][:20]:
+            self.stderr.write(f"row {error['row']} ({error['username']}): {error['errorType']}: {error['errorMessage']}")
+
+        self.stdout.write(f"Created {result['created']} users, skipped {len(result['errors'])} rows")
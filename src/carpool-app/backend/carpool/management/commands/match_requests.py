@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from carpool.matching import match_requests
+from carpool.models import DCU_CAMPUSES
+
+
+class Command(BaseCommand):
+    """
+    Matches open ride requests to trips in one batch (see matching.py), meant to be run on a schedule,
+    or left running with --interval.
+    """
+
+    help = "Proposes trips for open ride requests."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--campus", choices=DCU_CAMPUSES.keys())
+        parser.add_argument("--interval", type=float, help="Keep matching every this many seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            result = match_requests(options["campus"])
+            self.stdout.write(f"Proposed {result['proposed']} matches for {result['requests']} requests "
+                              f"and {result['trips']} trips in {result['seconds']:.2f}s, expired {result['expired']} requests")
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
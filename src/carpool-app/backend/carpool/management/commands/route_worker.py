@@ -0,0 +1,42 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from carpool.route_queue import claim_job, fail_job, finish_job
+from carpool.views import update_trip_route
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Runs queued trip route recomputations (see route_queue.py), any number of workers can run at once.
+    """
+
+    help = "Recomputes trip routes queued by joining and leaving trips."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit once there are no jobs ready to run.")
+        parser.add_argument("--poll-interval", type=float, default=1.0)
+
+    def handle(self, *args, **options):
+        routed = 0
+        while True:
+            job = claim_job()
+            if job is None:
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+                continue
+
+            try:
+                update_trip_route(job.trip_id)
+            except Exception:
+                logger.exception("Route recomputation failed for trip %s", job.trip_id)
+                fail_job(job)
+            else:
+                finish_job(job)
+                routed += 1
+
+        self.stdout.write(f"Routed {routed} trips")
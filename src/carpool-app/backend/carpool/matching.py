@@ -0,0 +1,177 @@
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .geo import detour_matrix, location_point
+from .models import RideRequest, Trip
+
+
+"""
+Batch matching
+
+Matches open ride requests to active trips with free seats all at once instead of one search per passenger.
+Requests are grouped by campus and direction, a detour matrix of every request against every trip in the group
+is estimated in one go (see geo.detour_matrix) and trips are assigned cheapest detour first without going over
+their seats. The matches are proposals, the driver of each trip confirms or declines them (see confirm_match).
+Run by the match_requests command, e.g. every minute.
+"""
+
+
+def expire_proposals(now):
+    """
+    Puts proposals back to open if they weren't confirmed within MATCHING_PROPOSAL_TTL minutes
+    or their trip has ended.
+    """
+
+    return RideRequest.objects.filter(status="proposed").filter(
+        Q(proposed_at__lt=now - timedelta(minutes=settings.MATCHING_PROPOSAL_TTL))
+        | Q(proposed_trip=None) | Q(proposed_trip__is_active=False)
+    ).update(status="open", proposed_trip=None, proposed_at=None, detour_km=None)
+
+
+def expire_requests(now):
+    """
+    Marks open requests expired once their time_of_departure is more than MATCHING_MAX_WAIT minutes ago,
+    as no trip could be matched to them any more.
+    """
+
+    return RideRequest.objects.filter(
+        status="open", time_of_departure__lt=now - timedelta(minutes=settings.MATCHING_MAX_WAIT)
+    ).update(status="expired")
+
+
+def request_point(ride_request):
+    """
+    :return: (lat, lng) of the stop a trip would make for the request, where the passenger is coming from
+    (to DCU) or going to (from DCU), or None if it has no coordinates
+    """
+
+    return location_point(ride_request.start if ride_request.to_campus else ride_request.destination)
+
+
+def match_costs(ride_requests, trips):
+    """
+    :return: numpy array (requests, trips) of the estimated detour (km) of each trip to take each request,
+    inf where a trip can't take a request (leaves more than MATCHING_MAX_WAIT minutes from when the passenger wants
+    to leave, was declined for the request, or either has no coordinates)
+    """
+
+    points = np.array([request_point(ride_request) or (np.nan, np.nan) for ride_request in ride_requests])
+    costs = detour_matrix(trips, points).T
+
+    request_times = np.array([ride_request.time_of_departure.timestamp() for ride_request in ride_requests])
+    trip_times = np.array([trip.time_of_departure.timestamp() for trip in trips])
+    costs[np.abs(request_times[:, None] - trip_times[None, :]) > settings.MATCHING_MAX_WAIT * 60] = np.inf
+
+    trip_indexes = {trip.id: j for j, trip in enumerate(trips)}
+    for i, ride_request in enumerate(ride_requests):
+        declined = [trip_indexes[trip_id] for trip_id in ride_request.declined_trips if trip_id in trip_indexes]
+        costs[i, declined] = np.inf
+
+    costs[np.isnan(costs)] = np.inf
+    return costs
+
+
+def assign(costs, seats, max_cost=np.inf, candidates=8):
+    """
+    Assigns each request (row) at most one trip (column) without going over any trip's seats,
+    taking (request, trip) pairs cheapest first. Only the candidates cheapest trips of each request are considered,
+    which keeps the work after the cost matrix to sorting requests * candidates pairs.
+
+    :return: numpy array of the trip index assigned to each request, -1 for requests left unmatched
+    """
+
+    n_requests, n_trips = costs.shape
+    assignment = np.full(n_requests, -1)
+    if not n_requests or not n_trips:
+        return assignment
+
+    k = min(candidates, n_trips)
+    columns = np.argpartition(costs, k - 1, axis=1)[:, :k].ravel()
+    rows = np.repeat(np.arange(n_requests), k)
+    pair_costs = costs[rows, columns]
+    allowed = pair_costs <= max_cost
+    rows, columns, pair_costs = rows[allowed], columns[allowed], pair_costs[allowed]
+
+    remaining = np.array(seats, dtype=int)
+    # cheapest first, ties go to the request that is first in the list
+    for pair in np.lexsort((rows, pair_costs)).tolist():
+        row, column = rows[pair], columns[pair]
+        if assignment[row] == -1 and remaining[column] > 0:
+            assignment[row] = column
+            remaining[column] -= 1
+    return assignment
+
+
+def match_requests(campus=None, now=None):
+    """
+    Proposes a trip for each open request leaving in the next MATCHING_WINDOW minutes where one can be found.
+
+    :param campus: key of DCU_CAMPUSES to only match requests to and from that campus
+    :return: dict of the number of "requests" and "trips" considered, the number of matches "proposed",
+    the number of requests "expired" (see expire_requests) and the "seconds" taken
+    """
+
+    started = time.perf_counter()
+    now = now or timezone.now()
+    expire_proposals(now)
+    expired = expire_requests(now)
+
+    # requests whose time has just passed (e.g. "leave now" requests) can still be matched to trips leaving soon
+    max_wait = timedelta(minutes=settings.MATCHING_MAX_WAIT)
+    ride_requests = RideRequest.objects.filter(
+        status="open", passenger__current_trip=None,
+        time_of_departure__gte=now - max_wait, time_of_departure__lte=now + timedelta(minutes=settings.MATCHING_WINDOW),
+    ).exclude(campus="")
+    if campus:
+        ride_requests = ride_requests.filter(campus=campus)
+
+    groups = {}
+    for ride_request in ride_requests.order_by("time_of_departure", "id"):
+        groups.setdefault((ride_request.campus, ride_request.to_campus), []).append(ride_request)
+
+    max_cost = settings.MATCHING_MAX_DETOUR_KM or np.inf
+    result = {"requests": 0, "trips": 0, "proposed": 0, "expired": expired}
+    for (group_campus, to_campus), group in groups.items():
+        # seats already held by proposals waiting for the driver aren't free
+        trips = list(
+            Trip.objects.filter(
+                is_active=True, campus=group_campus, to_campus=to_campus, available_seats__gt=0,
+                time_of_departure__gte=group[0].time_of_departure - max_wait,
+                time_of_departure__lte=group[-1].time_of_departure + max_wait,
+            ).annotate(proposed=Count("ride_requests", filter=Q(ride_requests__status="proposed")))
+            .prefetch_related("trip_waypoints").order_by("id")
+        )
+
+        costs = match_costs(group, trips)
+        seats = [trip.available_seats - trip.proposed for trip in trips]
+        matched = []
+        for i, j in enumerate(assign(costs, seats, max_cost, settings.MATCHING_CANDIDATES).tolist()):
+            if j >= 0:
+                ride_request = group[i]
+                ride_request.status = "proposed"
+                ride_request.proposed_trip = trips[j]
+                ride_request.proposed_at = now
+                ride_request.detour_km = round(float(costs[i, j]), 2)
+                matched.append(ride_request)
+
+        # only requests still open are proposed, a request cancelled while the group was being matched stays cancelled
+        proposed = 0
+        with transaction.atomic():
+            for ride_request in matched:
+                proposed += RideRequest.objects.filter(id=ride_request.id, status="open").update(
+                    status="proposed", proposed_trip=ride_request.proposed_trip, proposed_at=now,
+                    detour_km=ride_request.detour_km,
+                )
+
+        result["requests"] += len(group)
+        result["trips"] += len(trips)
+        result["proposed"] += proposed
+
+    result["seconds"] = time.perf_counter() - started
+    return result
@@ -0,0 +1,265 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+"""
+Metrics
+
+In-process counters and histograms of request latency, database queries and Directions calls by view,
+served in the Prometheus text format by the metrics view. Recording a value is a dict lookup and a few additions
+under a lock, the text is only built when scraped.
+Metrics are kept per worker process, so each worker has to be scraped (or run a single worker per instance).
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name of the view handling the current request, so calls made while handling it (e.g. to Directions)
+# are counted against it
+current_view = contextvars.ContextVar("current_view", default="none")
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=""):
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.extend(self.render_value(label_values, value))
+        return lines
+
+    def render_value(self, label_values, value):
+        return [f"{self.name}{format_labels(self.labels, label_values)} {value}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # a count per bucket (the last one being +Inf) then the sum of all values
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *label_values):
+        counts = self._values.get(label_values)
+        return sum(counts[:-1]) if counts else 0
+
+    def total(self, *label_values):
+        counts = self._values.get(label_values)
+        return counts[-1] if counts else 0
+
+    def render_value(self, label_values, counts):
+        lines, total = [], 0
+        for bound, count in zip((*self.buckets, "+Inf"), counts):
+            total += count
+            bucket_labels = format_labels(self.labels, label_values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {total}")
+        labels = format_labels(self.labels, label_values)
+        lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    "carpool_requests_total", "Requests handled, by view and status code.", ("view", "status")))
+request_latency = registry.register(Histogram(
+    "carpool_request_duration_seconds", "Time taken to handle requests, by view.", ("view",)))
+request_queries = registry.register(Histogram(
+    "carpool_request_queries", "Database queries made per request, by view.", ("view",), QUERY_BUCKETS))
+request_sql_time = registry.register(Histogram(
+    "carpool_request_sql_seconds", "Total time spent in database queries per request, by view.", ("view",)))
+directions_latency = registry.register(Histogram(
+    "carpool_directions_duration_seconds", "Time taken by routing provider calls, by calling view.", ("view",)))
+directions_errors = registry.register(Counter(
+    "carpool_directions_errors_total", "Routing provider calls that raised an error, by calling view.", ("view",)))
+active_trips = registry.register(Gauge(
+    "carpool_active_trips", "Trips that have not ended."))
+available_seats = registry.register(Gauge(
+    "carpool_available_seats", "Seats available on trips that have not ended."))
+active_passengers = registry.register(Gauge(
+    "carpool_active_passengers", "Passengers on trips that have not ended."))
+
+
+def time_directions(call, *args):
+    """
+    Calls the routing provider, recording how long it took (and whether it failed) against the current view.
+    """
+
+    view = current_view.get()
+    started = time.perf_counter()
+    try:
+        return call(*args)
+    except Exception:
+        directions_errors.inc(view)
+        raise
+    finally:
+        directions_latency.observe(time.perf_counter() - started, view)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - started
+
+
+def counting_queries(query_counter):
+    """
+    :return: context manager counting the queries made on every database with query_counter
+    """
+
+    stack = ExitStack()
+    for alias in settings.DATABASES:
+        stack.enter_context(connections[alias].execute_wrapper(query_counter))
+    return stack
+
+
+def record_request(response, view, seconds, query_counter):
+    request_latency.observe(seconds, view)
+    request_queries.observe(query_counter.queries, view)
+    request_sql_time.observe(query_counter.seconds, view)
+    requests_total.inc(view, response.status_code)
+
+
+class MetricsMiddleware:
+    """
+    Records the latency, status code and database queries of every request against the name of its view
+    ("unmatched" if no URL matched). Set METRICS_ENABLED to False to turn it off.
+    Works both ways round, so async views (e.g. trip_events) aren't switched to a thread to be measured.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        started = time.perf_counter()
+        query_counter = QueryCounter()
+        token = current_view.set("unmatched")
+        try:
+            with counting_queries(query_counter):
+                response = self.get_response(request)
+        finally:
+            view = current_view.get()
+            current_view.reset(token)
+
+        record_request(response, view, time.perf_counter() - started, query_counter)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        query_counter = QueryCounter()
+        token = current_view.set("unmatched")
+        try:
+            with counting_queries(query_counter):
+                response = await self.get_response(request)
+        finally:
+            view = current_view.get()
+            current_view.reset(token)
+
+        record_request(response, view, time.perf_counter() - started, query_counter)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        current_view.set(match.url_name or match.view_name if match else "unmatched")
@@ -1,9 +1,28 @@
+import json
+import zlib
+
 from django.db import models
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 # Create your models here.
 
+DCU_CAMPUSES = {
+    "gla": "Dublin City University, Collins Ave Ext, Whitehall, Dublin 9",
+    "pat": "DCU St Patrick's Campus, Drumcondra Road Upper, Drumcondra, Dublin 9, Ireland"
+}
+
+
+def journey_campus(start, destination):
+    """
+    :return: (whether the journey goes to DCU, key of the DCU_CAMPUSES campus it goes to or from, empty if neither)
+    """
+
+    campus_keys = {name: key for key, name in DCU_CAMPUSES.items()}
+    to_campus = destination.get("name") in campus_keys
+    campus_name = destination.get("name") if to_campus else start.get("name")
+    return to_campus, campus_keys.get(campus_name, "")
+
 
 class CarpoolUser(AbstractUser):
     id = models.AutoField(primary_key=True)
@@ -11,6 +30,8 @@ class CarpoolUser(AbstractUser):
     status = models.CharField(max_length=150, default="available")
     phone_no = models.DecimalField(max_digits=13, decimal_places=0, default="0871234567")
     photo = models.FileField(upload_to='defaults/', default="defaults/person-outline.svg")
+    # hash naming the thumbnails of the user's uploaded photo, see photos.py
+    photo_hash = models.CharField(max_length=64, default="", blank=True)
     profile_description = models.CharField(max_length=1000, default="")
     current_trip = models.ForeignKey("Trip", null=True, on_delete=models.SET_NULL)
 
@@ -35,12 +56,212 @@ class Trip(models.Model):
     ETA = models.DateTimeField(default=timezone.now)
     start = models.JSONField(default=dict)
     destination = models.JSONField(default=dict)
-    waypoints = models.JSONField(default=dict)
+    # passengers and waypoints are stored in TripPassenger and TripWaypoint,
+    # the legacy columns only hold data from before those tables existed until backfill_trips moves it.
+    legacy_waypoints = models.JSONField(default=dict, db_column="waypoints")
     distance = models.CharField(default="0", max_length=150)
     duration = models.CharField(default="0", max_length=150)
+    # total route distance in meters and duration in seconds, distance and duration are the same as text for the app
+    distance_m = models.IntegerField(default=0)
+    duration_s = models.IntegerField(default=0)
     route = models.JSONField(default=dict)
-    passengers = models.JSONField(default=dict)
+    legacy_passengers = models.JSONField(default=dict, db_column="passengers")
     available_seats = models.IntegerField(default=0, validators=[MinValueValidator(0), MaxValueValidator(5)])
+    # search columns, is_active is set by the trip views, to_campus and campus are kept up to date on save
+    is_active = models.BooleanField(default=False)
+    to_campus = models.BooleanField(default=True)
+    campus = models.CharField(max_length=3, default="", blank=True)
+    # bumped whenever the trip's passengers or seats change, see trips.py
+    version = models.IntegerField(default=0)
+    # set when the trip ends, ended trips are moved to TripHistory by the compact_trips command
+    ended_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["is_active", "to_campus", "campus", "available_seats"], name="trip_search_idx"),
+            models.Index(fields=["is_active", "to_campus", "campus", "time_of_departure"], name="trip_time_idx"),
+            models.Index(fields=["ended_at"], name="trip_ended_idx"),
+        ]
+
+    LEGACY_FIELDS = ("legacy_waypoints", "legacy_passengers")
+
+    def save(self, *args, **kwargs):
+        self.update_campus()
+        super().save(*args, **kwargs)
+
+    @property
+    def passengers(self):
+        """
+        Passengers in the format the app uses, {"passenger<id>": {"passengerName", "passengerID", "passengerStart", "passengerDestination"}}
+        """
+
+        return {f"passenger{passenger.user_id}": passenger.to_json() for passenger in self.trip_passengers.all()}
+
+    @property
+    def waypoints(self):
+        """
+        Waypoints in the format the app uses, {"waypoint<n>": {"name", "passenger", "lat", "lng"}}
+        """
+
+        return {f"waypoint{i}": waypoint.to_json() for i, waypoint in enumerate(self.trip_waypoints.all(), start=1)}
+
+    def create_members(self, passengers, waypoints):
+        """
+        Creates TripPassenger and TripWaypoint rows from dicts in the same format as Trip.passengers and Trip.waypoints.
+        Passengers whose user no longer exists are left out,
+        waypoints are linked to the passenger getting on or off there.
+        """
+
+        passengers = list(passengers.values())
+        user_ids = set(CarpoolUser.objects.filter(id__in=[int(passenger["passengerID"]) for passenger in passengers])
+                       .values_list("id", flat=True))
+
+        passenger_rows = [
+            TripPassenger(trip=self, user_id=int(passenger["passengerID"]), name=passenger.get("passengerName", ""),
+                          start=passenger["passengerStart"], destination=passenger["passengerDestination"])
+            for passenger in passengers if int(passenger["passengerID"]) in user_ids
+        ]
+        TripPassenger.objects.bulk_create(passenger_rows)
+
+        unmatched = list(passenger_rows)
+        waypoint_rows = []
+        for waypoint in waypoints.values():
+            passenger = next((row for row in unmatched if waypoint["name"] in (row.start, row.destination)), None)
+            if passenger is not None:
+                unmatched.remove(passenger)
+            waypoint_rows.append(TripWaypoint(
+                trip=self, passenger_id=passenger.user_id if passenger else None, name=waypoint["name"],
+                passenger_name=waypoint.get("passenger", ""), lat=waypoint.get("lat"), lng=waypoint.get("lng"),
+            ))
+        TripWaypoint.objects.bulk_create(waypoint_rows)
+
+    def update_campus(self):
+        """
+        Sets whether the trip goes to or from DCU and which campus (key of DCU_CAMPUSES, empty if neither).
+        """
+
+        self.to_campus, self.campus = journey_campus(self.start, self.destination)
+
+
+class TripHistory(models.Model):
+    """
+    An ended trip moved out of Trip, see history.py.
+    Only the columns needed to find a trip are kept as columns, everything else is in a compressed snapshot.
+    """
+
+    # the id the trip had in Trip
+    id = models.IntegerField(primary_key=True)
+    driver = models.ForeignKey("Driver", null=True, on_delete=models.SET_NULL, related_name="trip_history")
+    time_of_departure = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    to_campus = models.BooleanField(default=True)
+    campus = models.CharField(max_length=3, default="", blank=True)
+    distance_m = models.IntegerField(default=0)
+    duration_s = models.IntegerField(default=0)
+    passenger_count = models.IntegerField(default=0)
+    # zlib compressed JSON of the trip's fields, see history.trip_snapshot
+    snapshot = models.BinaryField()
+
+    class Meta:
+        indexes = [models.Index(fields=["driver", "time_of_departure"], name="trip_history_driver_idx")]
+
+    def to_json(self):
+        return json.loads(zlib.decompress(self.snapshot))
+
+
+class TripPassenger(models.Model):
+    id = models.AutoField(primary_key=True)
+    trip = models.ForeignKey("Trip", on_delete=models.CASCADE, related_name="trip_passengers")
+    user = models.ForeignKey("CarpoolUser", on_delete=models.CASCADE, related_name="trip_memberships")
+    name = models.CharField(max_length=150)
+    start = models.CharField(max_length=500)
+    destination = models.CharField(max_length=500)
+
+    class Meta:
+        ordering = ["id"]
+        constraints = [models.UniqueConstraint(fields=["trip", "user"], name="unique_trip_passenger")]
+
+    def to_json(self):
+        return {
+            "passengerName": self.name,
+            "passengerID": str(self.user_id),
+            "passengerStart": self.start,
+            "passengerDestination": self.destination,
+        }
+
+
+class TripWaypoint(models.Model):
+    id = models.AutoField(primary_key=True)
+    trip = models.ForeignKey("Trip", on_delete=models.CASCADE, related_name="trip_waypoints")
+    passenger = models.ForeignKey("CarpoolUser", null=True, on_delete=models.SET_NULL)
+    name = models.CharField(max_length=500)
+    passenger_name = models.CharField(max_length=150, default="")
+    lat = models.FloatField(null=True)
+    lng = models.FloatField(null=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def to_json(self):
+        return {"name": self.name, "passenger": self.passenger_name, "lat": self.lat, "lng": self.lng}
+
+
+class RouteJob(models.Model):
+    """
+    A queued route recomputation for a trip, there is at most one per trip so repeated changes are coalesced.
+    See route_queue.py.
+    """
+
+    trip = models.OneToOneField("Trip", primary_key=True, on_delete=models.CASCADE, related_name="route_job")
+    queued_at = models.DateTimeField(default=timezone.now)
+    claimed_until = models.DateTimeField(null=True)
+    attempts = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["claimed_until", "queued_at"], name="route_job_claim_idx")]
+
+
+class RideRequest(models.Model):
+    """
+    A passenger looking for a trip. Open requests are matched to trips in batches by the match_requests command
+    (see matching.py), the driver of the proposed trip then confirms or declines it.
+    """
+
+    id = models.AutoField(primary_key=True)
+    passenger = models.ForeignKey("CarpoolUser", on_delete=models.CASCADE, related_name="ride_requests")
+    start = models.JSONField(default=dict)
+    destination = models.JSONField(default=dict)
+    time_of_departure = models.DateTimeField(default=timezone.now)
+    to_campus = models.BooleanField(default=True)
+    campus = models.CharField(max_length=3, default="", blank=True)
+    # open -> proposed -> confirmed, proposals that are declined or not confirmed in time go back to open,
+    # open requests not matched by MATCHING_MAX_WAIT minutes after their time_of_departure are expired
+    status = models.CharField(max_length=20, default="open")
+    proposed_trip = models.ForeignKey("Trip", null=True, on_delete=models.SET_NULL, related_name="ride_requests")
+    proposed_at = models.DateTimeField(null=True)
+    detour_km = models.FloatField(null=True)
+    declined_trips = models.JSONField(default=list)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "campus", "to_campus", "time_of_departure"], name="ride_request_match_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.to_campus, self.campus = journey_campus(self.start, self.destination)
+        super().save(*args, **kwargs)
+
+    def to_json(self):
+        return {
+            "requestID": self.id,
+            "passengerID": str(self.passenger_id),
+            "passengerName": f"{self.passenger.first_name} {self.passenger.last_name[:1]}.",
+            "passengerStart": self.start,
+            "passengerDestination": self.destination,
+            "time_of_departure": self.time_of_departure,
+            "detour_km": self.detour_km,
+        }
 
 
 class Car(models.Model):
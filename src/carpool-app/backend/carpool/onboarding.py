@@ -0,0 +1,198 @@
+import csv
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from rest_framework.authtoken.models import Token
+
+from .models import CarpoolUser
+from .serializers import CarpoolUserSerializer
+
+
+"""
+Bulk onboarding
+
+Registers a cohort of users from a CSV (with a header row) or JSONL file of
+username, password, first_name, last_name and phone_no, used by the import_users command and endpoint
+(which only takes small uploads, see IMPORT_USERS_MAX_ROWS).
+Rows are checked the same way as /register (with the same errorType/errorMessage for each bad row) against
+one query for the existing usernames and with the validators of the user model's fields, passwords are hashed on a process pool, then users and their tokens
+are created with bulk_create in batches.
+"""
+
+FIELDS = ("username", "password", "first_name", "last_name", "phone_no")
+FORMATS = ("csv", "jsonl")
+# errorType of each user model field whose validators are run on every row, as sent back by /register
+FIELD_ERROR_TYPES = {"first_name": "first_name", "last_name": "last_name", "phone_no": "phone", "username": "username"}
+
+
+def file_format(filename, format=None):
+    """
+    :return: format if given, otherwise the format from filename's extension
+    """
+
+    format = format or os.path.splitext(filename)[1].lstrip(".").lower()
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported format {format!r}, expected one of {', '.join(FORMATS)}.")
+    return format
+
+
+def read_users(lines, format):
+    """
+    :param lines: iterable of text lines, e.g. a file opened with newline=""
+    :return: list of dicts of the registration fields (missing fields are empty)
+    """
+
+    if format == "csv":
+        try:
+            records = list(csv.DictReader(lines))
+        except csv.Error as error:
+            raise ValueError(f"Invalid CSV: {error}")
+    elif format == "jsonl":
+        records = []
+        for line_no, line in enumerate(lines, start=1):
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError as error:
+                    raise ValueError(f"Line {line_no} is not valid JSON: {error}")
+    else:
+        raise ValueError(f"Unsupported format {format!r}.")
+
+    rows = []
+    for record in records:
+        if not isinstance(record, dict):
+            raise ValueError("Each user must be an object.")
+        rows.append({field: str(record.get(field) or "") for field in FIELDS})
+    return rows
+
+
+def check_users(rows):
+    """
+    Checks every row the same way as /register, usernames are checked against one query for those already taken
+    and against earlier rows. Rows that pass are then checked with the validators of the user model's fields
+    (e.g. the characters allowed in a username).
+
+    :return: (valid rows, errors) with an error dict of "row" (numbered from 1), "username", "errorType"
+    and "errorMessage" for each invalid row
+    """
+
+    existing_usernames = set(
+        CarpoolUser.objects.filter(username__in={row["username"] for row in rows}).values_list("username", flat=True)
+    )
+    valid, errors = [], []
+    for row_no, row in enumerate(rows, start=1):
+        result = CarpoolUserSerializer.check_registration_data(
+            {**row, "reEnteredPassword": row["password"]}, existing_usernames=existing_usernames
+        )
+        if result is True:
+            result = check_fields(row)
+        if result is True:
+            valid.append(row)
+            existing_usernames.add(row["username"])
+        else:
+            errors.append({"row": row_no, "username": row["username"], **result})
+    return valid, errors
+
+
+def check_fields(row):
+    """
+    :return: True if the row's values pass the validators of their user model fields,
+    otherwise an errorType/errorMessage dict for the first field that doesn't
+    """
+
+    for field, error_type in FIELD_ERROR_TYPES.items():
+        value = phone_number(row[field]) if field == "phone_no" else row[field]
+        try:
+            CarpoolUser._meta.get_field(field).clean(value, None)
+        except ValidationError as error:
+            return {"errorType": error_type, "errorMessage": error.messages[0]}
+    return True
+
+
+def phone_number(phone_no):
+    return re.sub(r"\D", "", phone_no) or "0"
+
+
+def setup_worker():
+    # forked workers already have Django set up, spawned ones (e.g. on macOS) have to do it themselves
+    if not apps.ready:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+        django.setup()
+
+
+def hash_passwords(passwords, workers):
+    """
+    Hashes passwords with the default hasher, on a pool of workers processes if workers is more than 1.
+    """
+
+    if workers <= 1 or len(passwords) <= 1:
+        return [make_password(password) for password in passwords]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=setup_worker) as pool:
+        return list(pool.map(make_password, passwords, chunksize=max(len(passwords) // (workers * 4), 1)))
+
+
+def create_users(rows, password_hashes, batch_size):
+    """
+    Creates the users and their tokens, each batch in one transaction.
+    A batch with a username taken since it was checked is retried without it.
+
+    :return: (number of users created, rows of usernames that were taken)
+    """
+
+    created, taken = 0, []
+    for i in range(0, len(rows), batch_size):
+        batch = list(zip(rows[i:i + batch_size], password_hashes[i:i + batch_size]))
+        try:
+            with transaction.atomic():
+                created += save_batch(batch)
+        except IntegrityError:
+            existing_usernames = set(CarpoolUser.objects.filter(
+                username__in=[row["username"] for row, password_hash in batch]
+            ).values_list("username", flat=True))
+            taken.extend(row for row, password_hash in batch if row["username"] in existing_usernames)
+            with transaction.atomic():
+                created += save_batch([(row, password_hash) for row, password_hash in batch
+                                       if row["username"] not in existing_usernames])
+    return created, taken
+
+
+def save_batch(batch):
+    users = CarpoolUser.objects.bulk_create([
+        CarpoolUser(
+            username=row["username"],
+            password=password_hash,
+            first_name=row["first_name"].capitalize(),
+            last_name=row["last_name"].capitalize(),
+            phone_no=phone_number(row["phone_no"]),
+            is_admin=False,
+        )
+        for row, password_hash in batch
+    ])
+    Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users])
+    return len(users)
+
+
+def import_users(rows, batch_size=1000, workers=None):
+    """
+    Registers every valid row.
+
+    :return: dict of the number of users "created" and the "errors" of the rows that were not
+    """
+
+    valid, errors = check_users(rows)
+    created, taken = create_users(
+        valid, hash_passwords([row["password"] for row in valid], workers or os.cpu_count() or 1), batch_size
+    )
+    row_numbers = {id(row): row_no for row_no, row in enumerate(rows, start=1)}
+    errors.extend({"row": row_numbers[id(row)], "username": row["username"],
+                   "errorType": "username", "errorMessage": "Username already exists."} for row in taken)
+    errors.sort(key=lambda error: error["row"])
+    return {"created": created, "errors": errors}
@@ -0,0 +1,17 @@
+from rest_framework.permissions import BasePermission
+
+
+"""
+Permissions
+
+Admins of the app are users with CarpoolUser.is_admin set, rather than Django's is_staff.
+"""
+
+
+class IsCarpoolAdmin(BasePermission):
+    """
+    Allows access only to authenticated users with is_admin set.
+    """
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_authenticated and request.user.is_admin)
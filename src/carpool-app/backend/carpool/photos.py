@@ -0,0 +1,89 @@
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from PIL import Image, ImageOps
+
+
+"""
+Profile photos
+
+Uploaded photos are resized once, when they are uploaded, to square JPEG thumbnails of each of PHOTO_SIZES, so screens
+showing several users' photos fetch a few kilobytes each. Thumbnails are stored with the "photos" storage (local disk
+or an S3 compatible bucket, see settings) named by a hash of the upload, e.g. "<hash>/128.jpg". The file under a name
+never changes, so thumbnails are served with PHOTO_CACHE_CONTROL and the same photo uploaded twice is stored once.
+The original upload is not kept.
+"""
+
+# part of every photo hash, bump it when thumbnails are made differently so they get new names
+THUMBNAIL_VERSION = 1
+JPEG_QUALITY = 85
+
+
+class InvalidPhoto(Exception):
+    pass
+
+
+def photo_name(photo_hash, size):
+    return f"{photo_hash}/{size}.jpg"
+
+
+def photo_urls(photo_hash, request=None):
+    """
+    :return: dict of size to the URL of the photo's thumbnail (absolute if request is given), None if there is no photo
+    """
+
+    if not photo_hash:
+        return None
+    storage = storages["photos"]
+    urls = {str(size): storage.url(photo_name(photo_hash, size)) for size in settings.PHOTO_SIZES}
+    if request is not None:
+        urls = {size: request.build_absolute_uri(url) for size, url in urls.items()}
+    return urls
+
+
+def make_thumbnails(data, sizes):
+    """
+    :param data: bytes of an image file
+    :return: dict of size to the JPEG bytes of the image cropped to a square of that size
+    """
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEGs much larger than the biggest thumbnail are decoded at a fraction of their size, which is far quicker
+        image.draft("RGB", (max(sizes), max(sizes)))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        raise InvalidPhoto("Photo must be a JPEG, PNG, GIF or WebP image.")
+
+    thumbnails = {}
+    for size in sizes:
+        thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+        thumbnails[size] = buffer.getvalue()
+    return thumbnails
+
+
+def save_photo(user, data):
+    """
+    Stores the thumbnails of an uploaded photo, unless they are stored already, and makes it the user's photo.
+
+    :return: the photo's hash
+    """
+
+    if len(data) > settings.PHOTO_MAX_UPLOAD_MB * 1024 * 1024:
+        raise InvalidPhoto(f"Photo must be at most {settings.PHOTO_MAX_UPLOAD_MB:g} MB.")
+
+    photo_hash = hashlib.sha256(b"%d:" % THUMBNAIL_VERSION + data).hexdigest()
+    storage = storages["photos"]
+    missing = [size for size in settings.PHOTO_SIZES if not storage.exists(photo_name(photo_hash, size))]
+    if missing:
+        for size, thumbnail in make_thumbnails(data, missing).items():
+            storage.save(photo_name(photo_hash, size), ContentFile(thumbnail))
+
+    user.photo_hash = photo_hash
+    user.save(update_fields=["photo_hash"])
+    return photo_hash
@@ -0,0 +1,187 @@
+import re
+from datetime import datetime, timedelta
+
+from .models import DCU_CAMPUSES
+from .routing import format_distance, format_duration
+
+
+"""
+Trip routes
+
+Trip.route is stored as {"legs": [[start, destination, distance, duration, departure_time, arrival_time], ...],
+"passengers": {passenger id: leg index}} with distances in meters, durations in seconds and times as epoch seconds.
+The app still gets the original format from to_wire:
+{"route": [{"start", "destination", "distance", "duration", "departure_time", "arrival_time"}, ...]}
+with text distances/durations and times formatted as "%H:%M %m/%d/%Y".
+"""
+
+WIRE_TIME_FORMAT = "%H:%M %m/%d/%Y"
+
+
+class RouteLeg:
+    """
+    One leg of a trip route between two stops.
+    """
+
+    __slots__ = ("start", "destination", "distance", "duration", "departure_time", "arrival_time")
+
+    def __init__(self, start, destination, distance, duration, departure_time, arrival_time):
+        self.start = start
+        self.destination = destination
+        self.distance = distance
+        self.duration = duration
+        self.departure_time = departure_time
+        self.arrival_time = arrival_time
+
+    @property
+    def departure(self):
+        # times are sent to the app to the minute
+        return datetime.fromtimestamp(self.departure_time).replace(second=0)
+
+    @property
+    def arrival(self):
+        return datetime.fromtimestamp(self.arrival_time).replace(second=0)
+
+    def to_wire(self):
+        return {
+            "start": self.start,
+            "destination": self.destination,
+            "distance": format_distance(self.distance),
+            "duration": format_duration(self.duration),
+            "departure_time": datetime.fromtimestamp(self.departure_time).strftime(WIRE_TIME_FORMAT),
+            "arrival_time": datetime.fromtimestamp(self.arrival_time).strftime(WIRE_TIME_FORMAT),
+        }
+
+    @classmethod
+    def from_wire(cls, leg):
+        return cls(
+            leg["start"], leg["destination"], parse_distance(leg["distance"]), parse_duration(leg["duration"]),
+            int(datetime.strptime(leg["departure_time"], WIRE_TIME_FORMAT).timestamp()),
+            int(datetime.strptime(leg["arrival_time"], WIRE_TIME_FORMAT).timestamp()),
+        )
+
+
+class Route:
+    """
+    Route of a trip with a map of passenger id to the index of the leg they get on at (trips to DCU)
+    or get off at (trips from DCU), so a passenger's personalised departure/arrival time is found without a search.
+    """
+
+    __slots__ = ("legs", "passenger_legs")
+
+    def __init__(self, legs=None, passenger_legs=None):
+        self.legs = legs or []
+        self.passenger_legs = passenger_legs or {}
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Loads a route stored in Trip.route, in either the compact format or the original wire format.
+        """
+
+        if not data:
+            return cls()
+        if "legs" in data:
+            return cls(
+                [RouteLeg(*leg) for leg in data["legs"]],
+                {int(passenger_id): index for passenger_id, index in data.get("passengers", {}).items()},
+            )
+        return cls([RouteLeg.from_wire(leg) for leg in data.get("route", [])])
+
+    @classmethod
+    def for_trip(cls, trip):
+        route = cls.from_json(trip.route)
+        if not route.passenger_legs and trip.passengers:
+            route.index_passengers(trip)
+        return route
+
+    def to_json(self):
+        return {
+            "legs": [[getattr(leg, name) for name in RouteLeg.__slots__] for leg in self.legs],
+            "passengers": {str(passenger_id): index for passenger_id, index in self.passenger_legs.items()},
+        }
+
+    def to_wire(self):
+        return {"route": [leg.to_wire() for leg in self.legs]}
+
+    def index_passengers(self, trip):
+        """
+        Builds the passenger id to leg index map from the trip's passengers.
+        """
+
+        to_dcu = trip.start["name"] not in DCU_CAMPUSES.values()
+        leg_index = {}
+        for index, leg in enumerate(self.legs):
+            leg_index.setdefault(leg.start if to_dcu else leg.destination, index)
+
+        self.passenger_legs = {}
+        for passenger in trip.passengers.values():
+            location = passenger["passengerStart"] if to_dcu else passenger["passengerDestination"]
+            if location in leg_index:
+                self.passenger_legs[int(passenger["passengerID"])] = leg_index[location]
+
+    def passenger_leg(self, passenger_id):
+        index = self.passenger_legs.get(int(passenger_id))
+        return self.legs[index] if index is not None else None
+
+
+def route_to_wire(data):
+    """
+    Converts a stored Trip.route to the format sent to the app.
+    """
+
+    return Route.from_json(data).to_wire() if data else data
+
+
+def parse_distance(text):
+    """
+    Parses a Directions API distance, e.g. "850 m" or "1,024.5 km", into meters.
+    """
+
+    value, unit = text.replace(",", "").split()
+    return round(float(value) * (1000 if unit == "km" else 1))
+
+
+def parse_duration(text):
+    """
+    Parses a Directions API duration, e.g. "1 hour 5 mins", into seconds.
+    """
+
+    seconds = 0
+    for value, unit in re.findall(r"(\d+)\s*(day|hour|min|sec)", text):
+        seconds += int(value) * {"day": 86400, "hour": 3600, "min": 60, "sec": 1}[unit]
+    return seconds
+
+
+def format_trip_distance(meters):
+    """
+    Formats a trip's total distance for the app, in km to one decimal place without a trailing .0, e.g. "5.7 km", "12 km".
+    """
+
+    return f"{meters / 1000:.1f}".removesuffix(".0") + " km"
+
+
+def format_trip_duration(seconds):
+    """
+    Formats a trip's total duration for the app, e.g. "0 hours, 17 min, 00 sec".
+    """
+
+    hours, minutes, seconds = str(timedelta(seconds=seconds)).split(":")
+    return f"{hours} hours, {minutes.lstrip('0')} min, {seconds} sec"
+
+
+def trip_totals(trip):
+    """
+    :return: (meters, seconds) of a trip's route, from the legs of its route or,
+    for trips that haven't been routed, parsed from its distance and duration text (0 if it can't be parsed)
+    """
+
+    if trip.route:
+        legs = Route.from_json(trip.route).legs
+        return sum(leg.distance for leg in legs), sum(leg.duration for leg in legs)
+
+    try:
+        meters = parse_distance(trip.distance)
+    except ValueError:
+        meters = 0
+    return meters, parse_duration(trip.duration)
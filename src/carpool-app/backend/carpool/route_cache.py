@@ -0,0 +1,196 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+"""
+Route cache
+
+Caches Directions results so the same origin, destination and set of waypoints searched many times
+(e.g. during the morning rush) only costs one paid API call and one round trip.
+Entries are kept in a bounded in-memory LRU and are also written to an SQLite file so they survive worker restarts.
+"""
+
+
+def normalize_location(location):
+    """
+    Normalizes a location name so names only differing in case or whitespace share cache entries.
+    """
+
+    return " ".join(str(location).split()).casefold()
+
+
+class RouteCache:
+    """
+    Two tier (memory, disk) LRU cache with a TTL for Directions results.
+
+    Keys are built from the normalized origin, destination, waypoint multiset and departure time bucket,
+    see make_key for more info.
+    """
+
+    def __init__(self, max_entries=1024, ttl=900, departure_bucket=900, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.departure_bucket = departure_bucket
+        self.path = str(path) if path else None
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.path:
+            with self._connection() as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS route_cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+                )
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_entries=settings.ROUTE_CACHE_MAX_ENTRIES,
+            ttl=settings.ROUTE_CACHE_TTL,
+            departure_bucket=settings.ROUTE_CACHE_DEPARTURE_BUCKET,
+            path=settings.ROUTE_CACHE_PATH,
+        )
+
+    def make_key(self, origin, destination, waypoints=(), departure_time=None):
+        """
+        Builds the cache key for a route.
+        Waypoints are treated as a multiset since Directions optimizes their order anyway,
+        departure times are grouped into buckets of departure_bucket seconds.
+
+        :return: hex digest of the normalized route request
+        """
+
+        bucket = None
+        if departure_time is not None and self.departure_bucket:
+            bucket = int(departure_time.timestamp() // self.departure_bucket)
+
+        key = json.dumps([
+            normalize_location(origin),
+            normalize_location(destination),
+            sorted(normalize_location(waypoint) for waypoint in waypoints),
+            bucket,
+        ])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Gets a cached value, checking memory first then disk.
+
+        :return: the cached value, or None if it is missing or expired
+        """
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.path:
+            with self._connection() as connection:
+                row = connection.execute("SELECT value, expires FROM route_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[1] > now:
+                    value = json.loads(row[0])
+                    self._remember(key, value, row[1])
+                    with self._lock:
+                        self.disk_hits += 1
+                    return value
+                elif row is not None:
+                    connection.execute("DELETE FROM route_cache WHERE key = ?", (key,))
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl
+        self._remember(key, value, expires)
+
+        if self.path:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO route_cache (key, value, expires) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), expires)
+                )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+        if self.path:
+            with self._connection() as connection:
+                connection.execute("DELETE FROM route_cache")
+
+    def prune(self):
+        """
+        Removes expired entries from the disk tier.
+
+        :return: number of entries removed
+        """
+
+        if not self.path:
+            return 0
+        with self._connection() as connection:
+            return connection.execute("DELETE FROM route_cache WHERE expires <= ?", (time.time(),)).rowcount
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def _remember(self, key, value, expires):
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, so each thread keeps its own.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = connection
+        return connection
+
+
+_route_cache = None
+_route_cache_lock = threading.Lock()
+
+
+def get_route_cache():
+    """
+    :return: the cache set up by the ROUTE_CACHE_* settings, created the first time it is needed
+    so importing this module doesn't create the disk tier's file
+    """
+
+    global _route_cache
+    with _route_cache_lock:
+        if _route_cache is None:
+            _route_cache = RouteCache.from_settings()
+        return _route_cache
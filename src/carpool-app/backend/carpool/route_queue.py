@@ -0,0 +1,82 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import RouteJob
+
+
+"""
+Route queue
+
+Database backed queue of trip route recomputations, run by the route_worker command so joining or leaving a trip
+doesn't wait on the Directions API. There is one RouteJob per trip: queueing a trip that already has a job just
+moves its queued_at forward, so however many times a trip changes while waiting only its newest state is routed.
+
+A worker claims a job by setting claimed_until with a conditional UPDATE, so several workers can share the queue
+and a job claimed by a worker that died is picked up again once its claim runs out.
+"""
+
+
+def enqueue_route(trip_id):
+    """
+    Queues a route recomputation for a trip, coalescing it with any job already queued for the trip.
+    """
+
+    # a job already claimed keeps its claim so two workers never route the same trip at once,
+    # the worker sees the new queued_at when it finishes and leaves the job queued to run again.
+    RouteJob.objects.bulk_create(
+        [RouteJob(trip_id=trip_id, queued_at=timezone.now())],
+        update_conflicts=True, unique_fields=["trip"], update_fields=["queued_at", "attempts"],
+    )
+
+
+def route_pending(trip_id):
+    return RouteJob.objects.filter(trip_id=trip_id).exists()
+
+
+def claim_job():
+    """
+    Claims the oldest unclaimed job for ROUTE_QUEUE_LEASE seconds.
+
+    :return: the claimed RouteJob, or None if there are no jobs ready to run
+    """
+
+    now = timezone.now()
+    ready = RouteJob.objects.filter(Q(claimed_until=None) | Q(claimed_until__lt=now)).order_by("queued_at")
+    for job in ready[:10]:
+        claimed_until = now + timedelta(seconds=settings.ROUTE_QUEUE_LEASE)
+        claimed = RouteJob.objects.filter(trip_id=job.trip_id, claimed_until=job.claimed_until) \
+            .update(claimed_until=claimed_until, attempts=F("attempts") + 1)
+        if claimed:  # otherwise another worker claimed it first
+            job.claimed_until = claimed_until
+            job.attempts += 1
+            return job
+    return None
+
+
+def finish_job(job):
+    """
+    Removes a finished job, unless the trip was queued again while it ran.
+    """
+
+    finished, _ = RouteJob.objects.filter(trip_id=job.trip_id, queued_at=job.queued_at).delete()
+    if not finished:
+        RouteJob.objects.filter(trip_id=job.trip_id).update(claimed_until=None)
+
+
+def fail_job(job):
+    """
+    Retries a failed job after a backoff, or drops it after ROUTE_QUEUE_MAX_ATTEMPTS attempts.
+
+    :return: True if the job will be retried
+    """
+
+    if job.attempts >= settings.ROUTE_QUEUE_MAX_ATTEMPTS:
+        RouteJob.objects.filter(trip_id=job.trip_id, queued_at=job.queued_at).delete()
+        return False
+
+    retry_at = timezone.now() + timedelta(seconds=min(2 ** job.attempts, settings.ROUTE_QUEUE_LEASE))
+    RouteJob.objects.filter(trip_id=job.trip_id).update(claimed_until=retry_at)
+    return True
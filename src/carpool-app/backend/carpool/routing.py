@@ -0,0 +1,231 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import time_directions
+from .route_cache import get_route_cache, normalize_location
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Routing
+
+Gets directions between trip locations from the routing provider set by ROUTING_PROVIDER,
+reusing cached results where possible.
+"""
+
+# Directions requests share one keep-alive connection pool and one bounded thread pool across all searches.
+session = requests.Session()
+for scheme in ("https://", "http://"):  # http for local Directions servers, e.g. benchmarks/fake_directions.py
+    session.mount(scheme, requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=max(settings.ROUTING_MAX_WORKERS, 1)
+    ))
+executor = ThreadPoolExecutor(max_workers=max(settings.ROUTING_MAX_WORKERS, 1), thread_name_prefix="routing")
+
+
+# the Distance Matrix API takes at most 25 origins or destinations and 100 elements per request
+MATRIX_MAX_LOCATIONS = 25
+MATRIX_MAX_ELEMENTS = 100
+
+
+class RoutingError(Exception):
+    pass
+
+
+class RoutingProvider:
+    """
+    Base class for routing providers.
+
+    Locations are dicts with a "name" and, where known, "lat" and "lng" (the same as trip locations).
+    directions returns the parts of a Google Directions route used by the app:
+    {
+        "waypoint_order": [index into waypoints, in the order they are visited],
+        "legs": [{"start_address", "end_address", "distance": {"text", "value"}, "duration": {"text", "value"}}]
+    }
+    with distance values in meters and duration values in seconds.
+    travel_matrix returns (durations, distances), numpy arrays of shape (origins, destinations) of the travel time
+    in seconds and distance in meters from every origin to every destination, nan where there is no route.
+    departure_time (a datetime) asks for travel times in the traffic expected then, where the provider has it.
+    """
+
+    def directions(self, origin, destination, waypoints):
+        raise NotImplementedError
+
+    def travel_matrix(self, origins, destinations, departure_time=None):
+        raise NotImplementedError
+
+
+class GoogleDirectionsProvider(RoutingProvider):
+    """
+    Routes using the Google Directions and Distance Matrix APIs, locations are sent by name.
+    """
+
+    def directions(self, origin, destination, waypoints):
+        # only the parts of the response used by the app are kept,
+        # as the full response (with every step of every leg) is too large to cache.
+        response = session.get(settings.DIRECTIONS_BASE_URL, params={
+            "origin": origin["name"],
+            "destination": destination["name"],
+            "waypoints": "|".join(["optimize:true", *[waypoint["name"] for waypoint in waypoints]]),
+            "key": settings.GOOGLE_API_KEY,
+        }, timeout=settings.DIRECTIONS_TIMEOUT)
+        route = response.json()["routes"][0]
+
+        return {
+            "waypoint_order": route.get("waypoint_order", []),
+            "legs": [
+                {
+                    "start_address": leg["start_address"],
+                    "end_address": leg["end_address"],
+                    "distance": {"text": leg["distance"]["text"], "value": leg["distance"]["value"]},
+                    "duration": {"text": leg["duration"]["text"], "value": leg["duration"]["value"]},
+                }
+                for leg in route["legs"]
+            ],
+        }
+
+    def travel_matrix(self, origins, destinations, departure_time=None):
+        durations = np.full((len(origins), len(destinations)), np.nan)
+        distances = np.full((len(origins), len(destinations)), np.nan)
+
+        origins_per_request = min(len(origins), MATRIX_MAX_LOCATIONS)
+        destinations_per_request = max(min(MATRIX_MAX_LOCATIONS, MATRIX_MAX_ELEMENTS // max(origins_per_request, 1)), 1)
+        blocks = [(i, j) for i in range(0, len(origins), origins_per_request)
+                  for j in range(0, len(destinations), destinations_per_request)]
+
+        def request_block(block):
+            i, j = block
+            params = {
+                "origins": "|".join(origin["name"] for origin in origins[i:i + origins_per_request]),
+                "destinations": "|".join(destination["name"] for destination in destinations[j:j + destinations_per_request]),
+                "key": settings.GOOGLE_API_KEY,
+            }
+            if departure_time is not None:
+                params["departure_time"] = int(departure_time.timestamp())
+            response = session.get(settings.DISTANCE_MATRIX_BASE_URL, params=params,
+                                   timeout=settings.DIRECTIONS_TIMEOUT).json()
+            if response.get("status") != "OK":
+                raise RoutingError(f"Distance Matrix request failed: {response.get('status')}")
+            return response["rows"]
+
+        # blocks are requested concurrently, a block that doesn't come back in time is left as nan
+        for (i, j), rows in zip(blocks, map_with_deadline(request_block, blocks, settings.DIRECTIONS_TIMEOUT)):
+            for row, result in enumerate(rows or []):
+                for column, element in enumerate(result["elements"]):
+                    if element.get("status") == "OK":
+                        durations[i + row, j + column] = element["duration"]["value"]
+                        distances[i + row, j + column] = element["distance"]["value"]
+
+        return durations, distances
+
+
+_provider = None
+
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        _provider = import_string(settings.ROUTING_PROVIDER)()
+    return _provider
+
+
+def get_directions(origin, destination, waypoints=(), departure_time=None):
+    """
+    Gets the optimal route from origin to destination passing through all waypoints.
+
+    Waypoints are sent in a normalized order so the same set of waypoints always produces the same request,
+    which lets the result be shared through the route cache regardless of the order the waypoints are given in.
+
+    :return: dict containing the route "legs" and "ordered_waypoints", the waypoints in the order they are visited
+    """
+
+    waypoints = sorted(waypoints, key=lambda waypoint: normalize_location(waypoint["name"]))
+    route_cache = get_route_cache()
+    key = route_cache.make_key(origin["name"], destination["name"], [waypoint["name"] for waypoint in waypoints],
+                               departure_time)
+
+    route = route_cache.get(key)
+    if route is None:
+        route = time_directions(get_provider().directions, origin, destination, waypoints)
+        route_cache.set(key, route)
+
+    return {
+        "legs": route["legs"],
+        "ordered_waypoints": [waypoints[i] for i in route["waypoint_order"]],
+    }
+
+
+def get_travel_matrix(origins, destinations, departure_time=None):
+    """
+    Gets the travel time and distance from every origin to every destination from the routing provider,
+    see RoutingProvider.
+
+    :return: (durations in seconds, distances in meters), numpy arrays of shape (origins, destinations)
+    """
+
+    return time_directions(get_provider().travel_matrix, list(origins), list(destinations), departure_time)
+
+
+def format_distance(meters):
+    """
+    Formats a distance the same way as the Directions API, e.g. "850 m", "5.7 km", "1,024 km".
+    """
+
+    if meters < 1000:
+        return f"{int(meters)} m"
+    km = meters / 1000
+    return f"{km:,.1f} km" if km < 100 else f"{round(km):,} km"
+
+
+def format_duration(seconds):
+    """
+    Formats a duration the same way as the Directions API, e.g. "1 min", "17 mins", "1 hour 5 mins".
+    """
+
+    minutes = max(round(seconds / 60), 1)
+    hours, minutes = divmod(minutes, 60)
+    parts = []
+    if hours:
+        parts.append(f"{hours} hour{'s' if hours != 1 else ''}")
+    if minutes or not hours:
+        parts.append(f"{minutes} min{'s' if minutes != 1 else ''}")
+    return " ".join(parts)
+
+
+def map_with_deadline(func, items, timeout):
+    """
+    Calls func for each item, concurrently on the routing thread pool if ROUTING_MAX_WORKERS is more than 1.
+    Calls that have not finished within timeout seconds are abandoned rather than waited on,
+    calls that raise are logged and treated the same way.
+
+    :return: list of results in the same order as items, with None for each call that did not finish in time
+    """
+
+    def call(item):
+        try:
+            return func(item)
+        except Exception:
+            logger.exception("Routing %r failed", item)
+            return None
+
+    if settings.ROUTING_MAX_WORKERS <= 1:
+        deadline = time.monotonic() + timeout
+        results = []
+        for item in items:
+            results.append(call(item) if time.monotonic() < deadline else None)
+        return results
+
+    # each call runs in a copy of the caller's context, so metrics are recorded against the caller's view
+    futures = [executor.submit(contextvars.copy_context().run, call, item) for item in items]
+    done, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        future.cancel()
+
+    return [future.result() if future in done else None for future in futures]
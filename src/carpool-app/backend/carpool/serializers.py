@@ -1,6 +1,9 @@
 import re
+from django.core.serializers.json import DjangoJSONEncoder
+from django.forms.models import model_to_dict
 from rest_framework import serializers
 from .models import CarpoolUser, Driver, Car, Trip, Passenger
+from .route import route_to_wire, trip_totals
 import phonenumbers
 
 
@@ -36,12 +39,14 @@ class CarpoolUserSerializer(serializers.ModelSerializer):
             return False
 
     @staticmethod
-    def check_registration_data(data):
+    def check_registration_data(data, existing_usernames=None):
         """
         This is used in the API for /register,
         it checks if each field entered through the app is valid in the order each field is in.
 
         :param data:
+        :param existing_usernames: set of usernames already taken, used instead of querying for the username
+        when checking many users at once (see onboarding.py)
         :return: True, if all fields are valid, otherwise a dict containing the appropriate error type and message is returned
         """
 
@@ -69,7 +74,8 @@ class CarpoolUserSerializer(serializers.ModelSerializer):
         elif len(data["username"]) > 150:
             error_type = "username"
             error_message = "Username must be no longer than 150 characters."
-        elif CarpoolUser.objects.filter(username=data["username"]).count() > 0:
+        elif (data["username"] in existing_usernames if existing_usernames is not None
+              else CarpoolUser.objects.filter(username=data["username"]).count() > 0):
             error_type = "username"
             error_message = "Username already exists."
         elif len(data["password"]) < 6: 
@@ -162,11 +168,66 @@ class TripSerializer(serializers.ModelSerializer):
                     ETA=data["ETA"],
                     start=data["start"], 
                     destination=data["destination"],
-                    waypoints=data["waypoints"],
                     distance=data["distance"],
                     duration=data["duration"],
-                    passengers=data["passengers"],
-                    available_seats=data["available_seats"]
+                    available_seats=data["available_seats"],
+                    is_active=True
                    )
+        trip.distance_m, trip.duration_s = trip_totals(trip)
         trip.save()
-        return trip
\ No newline at end of file
+        trip.create_members(data["passengers"], data["waypoints"])
+        return trip
+
+
+json_encoder = DjangoJSONEncoder()
+
+
+# fields of a trip sent back by get_trips, the ones the app has always been sent
+# (columns added since for searching and bookkeeping aren't part of the response)
+TRIP_FIELDS = (
+    "driver_id", "time_of_departure", "ETA", "start", "destination", "waypoints",
+    "distance", "duration", "route", "passengers", "available_seats",
+)
+# every field of a trip, the search and bookkeeping columns after TRIP_FIELDS
+ALL_TRIP_FIELDS = TRIP_FIELDS + tuple(
+    field.name for field in Trip._meta.concrete_fields
+    if not field.primary_key and field.name not in TRIP_FIELDS + Trip.LEGACY_FIELDS
+)
+
+
+def trip_fields(trip, names=TRIP_FIELDS):
+    """
+    Gets fields of a trip the same as the "fields" of django's json serializer
+    (foreign keys as ids, dates in DjangoJSONEncoder's format) without encoding and decoding the trip as JSON,
+    the route, waypoints and passengers are in the format the app uses.
+    Used by get_trips to serialize many trips quickly.
+
+    :param trip:
+    :param names: the fields to get, TRIP_FIELDS by default or ALL_TRIP_FIELDS
+    :return: dict of field name to JSON compatible value
+    """
+
+    fields = {}
+    for name in names:
+        if name == "route":
+            value = route_to_wire(trip.route)
+        elif name in ("waypoints", "passengers"):
+            value = getattr(trip, name)
+        else:
+            value = Trip._meta.get_field(name).value_from_object(trip)
+            if not isinstance(value, (str, int, float, dict, list, type(None))):
+                value = json_encoder.default(value)
+        fields[name] = value
+    return fields
+
+
+def trip_to_dict(trip):
+    """
+    model_to_dict for trips sent to the app, with the route, waypoints and passengers in the format the app uses.
+    """
+
+    trip_dict = model_to_dict(trip, exclude=Trip.LEGACY_FIELDS)
+    trip_dict["route"] = route_to_wire(trip_dict["route"])
+    trip_dict["waypoints"] = trip.waypoints
+    trip_dict["passengers"] = trip.passengers
+    return trip_dict
\ No newline at end of file
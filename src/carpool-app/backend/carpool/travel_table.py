@@ -0,0 +1,179 @@
+import bisect
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .geo import haversine, location_point
+from .models import DCU_CAMPUSES
+
+
+"""
+Campus travel time tables
+
+Every trip starts or ends at a DCU campus, so the travel time between any point and a campus is looked up in a table
+of travel times to and from each campus from every cell of a grid over Greater Dublin, instead of asking the routing
+provider. The table is built offline by the build_travel_table command, optionally with a slice for each time of day
+(hour the slice starts), and loaded memory mapped so a lookup is an index into the file and only the pages used
+are read.
+
+The table is saved as a .npy array of shape (campuses, 2, slices, rows, cols) of float32 seconds (nan where there is
+no route), the second axis being to then from the campus, with its grid in a .json file next to it.
+"""
+
+# where trips to and from each campus actually start/end, for the routing provider
+CAMPUS_LOCATIONS = {
+    "gla": {"name": DCU_CAMPUSES["gla"], "lat": 53.3863494, "lng": -6.2565914},
+    "pat": {"name": DCU_CAMPUSES["pat"], "lat": 53.3706459, "lng": -6.2596842},
+}
+
+TO_CAMPUS, FROM_CAMPUS = 0, 1
+
+
+class TravelTable:
+    """
+    Travel times to and from each campus over a grid of cells of cell_lat by cell_lng degrees,
+    the first starting at (south, west).
+    """
+
+    def __init__(self, times, campuses, south, west, cell_lat, cell_lng, slices=(0,)):
+        self.times = times
+        self.campuses = list(campuses)
+        self.south = south
+        self.west = west
+        self.cell_lat = cell_lat
+        self.cell_lng = cell_lng
+        self.slices = list(slices)
+        self._campus_indexes = {campus: i for i, campus in enumerate(self.campuses)}
+
+    @classmethod
+    def empty(cls, campuses, south, west, north, east, cell_m, slices=(0,)):
+        """
+        :return: table covering (south, west) to (north, east) with cells about cell_m meters wide, all nan
+        """
+
+        cell_lat = cell_m / 1000 / float(haversine(south, west, south + 1, west))
+        cell_lng = cell_m / 1000 / float(haversine((south + north) / 2, west, (south + north) / 2, west + 1))
+        rows = max(int(np.ceil((north - south) / cell_lat)), 1)
+        cols = max(int(np.ceil((east - west) / cell_lng)), 1)
+        times = np.full((len(campuses), 2, len(slices), rows, cols), np.nan, dtype=np.float32)
+        return cls(times, campuses, south, west, cell_lat, cell_lng, sorted(slices))
+
+    @classmethod
+    def load(cls, path):
+        meta = json.loads(Path(path).with_suffix(".json").read_text())
+        return cls(np.load(path, mmap_mode="r"), meta["campuses"], meta["south"], meta["west"],
+                   meta["cell_lat"], meta["cell_lng"], meta["slices"])
+
+    def save(self, path):
+        # written next to the table and moved over it, so processes with the old table mapped keep reading it
+        path = Path(path)
+        with open(path.with_suffix(".tmp"), "wb") as table_file:
+            np.save(table_file, np.asarray(self.times, dtype=np.float32))
+        path.with_suffix(".json.tmp").write_text(json.dumps({
+            "campuses": self.campuses, "south": self.south, "west": self.west,
+            "cell_lat": self.cell_lat, "cell_lng": self.cell_lng, "slices": self.slices,
+        }))
+        os.replace(path.with_suffix(".tmp"), path)
+        os.replace(path.with_suffix(".json.tmp"), path.with_suffix(".json"))
+
+    @property
+    def shape(self):
+        return self.times.shape[-2:]
+
+    @property
+    def cell_km(self):
+        # length of a cell's diagonal, the furthest a point can be from where its cell was routed from
+        return float(haversine(self.south, self.west, self.south + self.cell_lat, self.west + self.cell_lng))
+
+    def cell_locations(self):
+        """
+        :return: location dicts of the centre of every cell, in row major order, named by their coordinates
+        so they can be sent to the Google APIs
+        """
+
+        rows, cols = self.shape
+        lats = self.south + (np.arange(rows) + 0.5) * self.cell_lat
+        lngs = self.west + (np.arange(cols) + 0.5) * self.cell_lng
+        return [{"name": f"{lat:.6f},{lng:.6f}", "lat": float(lat), "lng": float(lng)} for lat in lats for lng in lngs]
+
+    def slice_index(self, departure_time=None):
+        """
+        :return: index of the slice starting last at or before the (local) hour of departure_time,
+        the last slice of the day before the first one starts
+        """
+
+        if departure_time is None:
+            return 0
+        if timezone.is_aware(departure_time):
+            departure_time = timezone.localtime(departure_time)
+        return (bisect.bisect_right(self.slices, departure_time.hour) - 1) % len(self.slices)
+
+    def travel_time(self, campus, to_campus, lat, lng, departure_time=None):
+        """
+        :param campus: key of DCU_CAMPUSES
+        :return: seconds from (lat, lng) to the campus (or from the campus if not to_campus),
+        nan if the table doesn't have it
+        """
+
+        campus_index = self._campus_indexes.get(campus)
+        row = int(np.floor((lat - self.south) / self.cell_lat))
+        col = int(np.floor((lng - self.west) / self.cell_lng))
+        rows, cols = self.shape
+        if campus_index is None or not (0 <= row < rows and 0 <= col < cols):
+            return np.nan
+        return float(self.times[campus_index, TO_CAMPUS if to_campus else FROM_CAMPUS,
+                                self.slice_index(departure_time), row, col])
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def get_travel_table():
+    """
+    :return: the table at TRAVEL_TABLE_PATH, loaded the first time it is needed, or None if there isn't one
+    """
+
+    global _table
+    path = str(settings.TRAVEL_TABLE_PATH or "")
+    with _table_lock:
+        if _table is None or _table[0] != path:
+            _table = (path, TravelTable.load(path) if path and os.path.exists(path) else None)
+        return _table[1]
+
+
+def duration_estimates(trips, lat, lng, table=None):
+    """
+    Estimates of each trip's duration (seconds) with a stop at (lat, lng), without any routing requests:
+    the table's time between the stop and the trip's campus plus the straight line time between the stop and the
+    trip's other end at TRIP_SEARCH_MAX_SPEED_KPH. The table time is taken as if the stop were anywhere in its cell.
+
+    These are not strict lower bounds (the road from the centre of the stop's cell to the stop can take longer than
+    the cell allows for, and traffic can be slower than the table's slice), so they are only good for ranking trips,
+    not for ruling them out.
+
+    :return: numpy array of the estimate of each trip, nan where the table doesn't have one (or there is no table)
+    """
+
+    table = table if table is not None else get_travel_table()
+    estimates = np.full(len(trips), np.nan)
+    if table is None:
+        return estimates
+
+    max_speed = settings.TRIP_SEARCH_MAX_SPEED_KPH / 3600
+    cell_time = table.cell_km / max_speed
+    times = {}
+    for i, trip in enumerate(trips):
+        other_end = location_point(trip.start if trip.to_campus else trip.destination)
+        if other_end is None:
+            continue
+        key = (trip.campus, trip.to_campus, table.slice_index(trip.time_of_departure))
+        if key not in times:
+            times[key] = table.travel_time(trip.campus, trip.to_campus, lat, lng, trip.time_of_departure)
+        estimates[i] = max(times[key] - cell_time, 0) + float(haversine(*other_end, lat, lng)) / max_speed
+    return estimates
@@ -0,0 +1,104 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .authentication import invalidate_users
+from .events import publish_trip_event
+from .models import CarpoolUser, Trip, TripPassenger, TripWaypoint
+
+
+"""
+Trip membership
+
+Changes to who is in a trip, done with a fixed number of short queries in one transaction each.
+
+Seats are reserved with a conditional UPDATE (available_seats > 0) so concurrent joins can never take more seats
+than are free, and no locks are held while the slow route recomputation runs afterwards.
+Every change to a trip's passengers bumps Trip.version, a route is only saved if the version it was computed for
+is still current (see update_trip_route in views.py).
+"""
+
+
+class TripFull(Exception):
+    pass
+
+
+class AlreadyInTrip(Exception):
+    pass
+
+
+def add_passenger(trip_id, membership, waypoint=None):
+    """
+    Reserves a seat on a trip and saves the passenger's TripPassenger row, and TripWaypoint row if they have one.
+
+    :raises TripFull: if the trip has no free seats (or no longer exists)
+    :raises AlreadyInTrip: if the passenger is already in the trip
+    """
+
+    with transaction.atomic():
+        reserved = Trip.objects.filter(id=trip_id, available_seats__gt=0) \
+            .update(available_seats=F("available_seats") - 1, version=F("version") + 1)
+        if not reserved:
+            raise TripFull
+
+        try:
+            membership.save()
+        except IntegrityError:
+            # the seat taken above is given back when the transaction is rolled back
+            raise AlreadyInTrip
+
+        if waypoint is not None:
+            waypoint.save()
+        CarpoolUser.objects.filter(id=membership.user_id).update(current_trip=trip_id, status="passenger_busy")
+        invalidate_users([membership.user_id])
+        publish_trip_event(trip_id, "passenger_joined", passenger=membership.to_json())
+
+
+def remove_passenger(trip_id, user_id):
+    """
+    Removes a passenger and their waypoint from a trip, giving back their seat.
+
+    :return: True if the passenger was in the trip
+    """
+
+    with transaction.atomic():
+        # each passenger has their own waypoint, so other passengers at the same location keep theirs
+        TripWaypoint.objects.filter(trip_id=trip_id, passenger_id=user_id).delete()
+        removed, _ = TripPassenger.objects.filter(trip_id=trip_id, user_id=user_id).delete()
+        if removed:
+            Trip.objects.filter(id=trip_id) \
+                .update(available_seats=F("available_seats") + 1, version=F("version") + 1)
+            publish_trip_event(trip_id, "passenger_left", passenger={"passengerID": str(user_id)})
+        CarpoolUser.objects.filter(id=user_id).update(current_trip=None, status="available")
+        invalidate_users([user_id])
+
+    return bool(removed)
+
+
+def end_trips(trip_ids, delete=False):
+    """
+    Ends the given trips, setting the status of everyone in them to "available" and removing their current_trip.
+    Trips are marked inactive with the time they ended (they are moved to TripHistory later, see history.py),
+    or deleted if delete is set (when a driver cancels their trip).
+
+    :return: list of the user ids of all the people who were in the trips
+    """
+
+    trip_ids = list(trip_ids)
+    with transaction.atomic():
+        # rows are locked so nobody joins one of the trips between reading the members and resetting them
+        user_ids = list(CarpoolUser.objects.select_for_update().filter(current_trip__in=trip_ids)
+                        .order_by("id").values_list("id", flat=True))
+        CarpoolUser.objects.filter(id__in=user_ids).update(status="available", current_trip=None)
+        invalidate_users(user_ids)
+
+        trips = Trip.objects.filter(id__in=trip_ids)
+        if delete:
+            trips.delete()
+        else:
+            trips.update(is_active=False, ended_at=timezone.now())
+
+        for trip_id in trip_ids:
+            publish_trip_event(trip_id, "trip_removed" if delete else "trip_ended")
+
+    return user_ids
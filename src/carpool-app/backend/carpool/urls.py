@@ -1,16 +1,19 @@
 from . import views
-from django.urls import path
+from django.urls import path, re_path
 from rest_framework.authtoken.views import obtain_auth_token
 
 urlpatterns = [
     path("register", views.register, name="register"),
     path("login", views.login, name="login"),
+    path("import_users", views.import_users, name="import-users"),
     path("logout", views.logout, name="logout"),
     path("token", obtain_auth_token, name="api-auth-token"),
     path("delete", views.delete_account, name="delete-account"),
     path("get_profile", views.get_profile, name="get-profile"),
     path("set_profile_description", views.set_profile_description, name="set-profile-description"),
     path("update_phone", views.update_phone, name="update-phone"),
+    path("upload_photo", views.upload_photo, name="upload-photo"),
+    re_path(r"^photos/(?P<name>[0-9a-f]{64}/[0-9]+\.jpg)$", views.photo, name="photo"),
     path("get_driver", views.get_driver, name="get-driver"),
     path("create_driver", views.create_driver, name="create-driver"),
     path("create_passenger", views.create_passenger, name="create-passenger"),
@@ -20,5 +23,13 @@ urlpatterns = [
     path("add_passenger_to_trip", views.add_passenger_to_trip, name="add-passenger-to-trip"),
     path("join_trip", views.join_trip, name="join-trip"),
     path("end_trip", views.end_trip, name="end-trip"),
+    path("end_trips", views.end_trips_bulk, name="end-trips"),
     path("passenger_leave_trip", views.passenger_leave_trip, name="passenger-leave-trip"),
+    path("request_ride", views.request_ride, name="request-ride"),
+    path("match_proposals", views.match_proposals, name="match-proposals"),
+    path("confirm_match", views.confirm_match, name="confirm-match"),
+    path("trip_events", views.trip_events, name="trip-events"),
+    path("trip_events/ticket", views.trip_events_ticket, name="trip-events-ticket"),
+    path("route_cache_stats", views.route_cache_stats, name="route-cache-stats"),
+    path("metrics", views.metrics, name="metrics"),
 ]
@@ -1,27 +1,58 @@
+import base64
+import copy
+import io
 import json
+import logging
+import time
 
-import requests
 from datetime import timedelta, datetime
-from django.core import serializers as django_serializers
+import numpy as np
 from django.forms.models import model_to_dict
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate, login as django_login
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import status
 from rest_framework.authtoken.models import Token
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
 from .serializers import *
 from .models import *
+from . import metrics as carpool_metrics
+from . import onboarding
+from . import photos
+from .authentication import CachedTokenAuthentication, invalidate_users
+from .events import publish_trip_event, stream_trip_events
+from .geo import estimate_detours, location_point, via_distances
+from .insertion import estimate_insertions
+from .permissions import IsCarpoolAdmin
+from .renderers import ORJSONRenderer
+from .route import Route, RouteLeg, format_trip_distance, format_trip_duration, route_to_wire
+from .route_cache import get_route_cache
+from .route_queue import enqueue_route, route_pending
+from .routing import RoutingError, get_directions, map_with_deadline
+from .travel_table import duration_estimates
+from .trips import AlreadyInTrip, TripFull, add_passenger, end_trips, remove_passenger
 from django.conf import settings
-import urllib
+from django.core import signing
+from django.core.files.storage import storages
+from backend.database import read_database, read_only
 import phonenumbers
+import requests
 
 
 """
 Carpool API
 """
 
+logger = logging.getLogger(__name__)
+
 @api_view(["POST"])
 def register(request):
     """
@@ -55,6 +86,35 @@ def register(request):
     return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["POST"])
+@permission_classes([IsCarpoolAdmin])
+def import_users(request):
+    """
+    Registers a cohort of users from an uploaded CSV or JSONL "file" (see onboarding.py),
+    the format is taken from the file name unless "format" is given.
+    Rows that fail the same checks as /register are skipped, their errors are sent back with their row numbers.
+    Passwords are hashed in this process rather than forking a pool from the web worker, so uploads of more than
+    IMPORT_USERS_MAX_ROWS users are turned away, whole cohorts are imported with the import_users command.
+    """
+
+    upload = request.FILES.get("file")
+    if upload is None:
+        return Response({"error": "No file uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        format = onboarding.file_format(upload.name, request.data.get("format"))
+        rows = onboarding.read_users(io.TextIOWrapper(upload, encoding="utf-8-sig", newline=""), format)
+    except ValueError as error:
+        return Response({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+    if len(rows) > settings.IMPORT_USERS_MAX_ROWS:
+        return Response({"error": f"At most {settings.IMPORT_USERS_MAX_ROWS} users can be uploaded at once, "
+                                  "use the import_users command for larger cohorts."},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    return Response(onboarding.import_users(rows, workers=1), status=status.HTTP_200_OK)
+
+
 @api_view(["POST"])
 def login(request):
     """
@@ -79,7 +139,7 @@ def login(request):
                 user_status = "available"
                 passenger_route = {} 
                 if carpool_user.current_trip is not None: 
-                    trip = model_to_dict(carpool_user.current_trip) 
+                    trip = trip_to_dict(carpool_user.current_trip)
                     trip["driverPhone"] = carpool_user.current_trip.driver_id.uid.phone_no
                     trip["car"] = model_to_dict(carpool_user.current_trip.driver_id.car)
                     trip["driverName"] = f"{carpool_user.current_trip.driver_id.uid.first_name} {carpool_user.current_trip.driver_id.uid.last_name[0]}."
@@ -93,28 +153,34 @@ def login(request):
                         """
 
                         user_status = "passenger_busy"
-                        passenger_info = trip["passengers"][f"passenger{carpool_user.id}"]
+                        route_leg = Route.for_trip(carpool_user.current_trip).passenger_leg(carpool_user.id)
+                        if route_leg is None:
+                            # the passenger's leg isn't in the route until the route worker has recomputed it,
+                            # until then their own stops are sent with the trip's departure and arrival times
+                            trip["route_pending"] = route_pending(carpool_user.current_trip_id)
+                            membership = trip["passengers"].get(f"passenger{carpool_user.id}", {})
+                            route_leg = RouteLeg(
+                                membership.get("passengerStart", trip["start"]["name"]),
+                                membership.get("passengerDestination", trip["destination"]["name"]), 0, 0,
+                                int(trip["time_of_departure"].timestamp()), int(trip["ETA"].timestamp()),
+                            )
 
                         dcu_campuses = ["Dublin City University, Collins Ave Ext, Whitehall, Dublin 9",
                                         "DCU St Patrick's Campus, Drumcondra Road Upper, Drumcondra, Dublin 9, Ireland"]
                         # If trip is TO DCU
                         if trip["start"]["name"] not in dcu_campuses:
-                            passenger_loc = passenger_info["passengerStart"]
-                            route_info = [r for r in trip["route"]["route"] if r["start"] == passenger_loc][0]
                             passenger_route = {
                                 "passengerDestLoc": trip["destination"]["name"],
                                 "passengerArrivalTime" : trip["ETA"].strftime("%Y-%m-%dT%H:%M"),
-                                "passengerStartLoc": route_info["start"],
-                                "passengerDepartureTime": datetime.strptime(str(route_info["departure_time"]), "%H:%M %m/%d/%Y"),
+                                "passengerStartLoc": route_leg.start,
+                                "passengerDepartureTime": route_leg.departure,
                             }
 
                         # If trip is FROM DCU
                         else:
-                            passenger_loc = passenger_info["passengerDestination"]
-                            route_info = [r for r in trip["route"]["route"] if r["destination"] == passenger_loc][0]
                             passenger_route = {
-                                "passengerDestLoc": route_info["destination"],
-                                "passengerArrivalTime" : datetime.strptime(str(route_info["arrival_time"]), "%H:%M %m/%d/%Y"),
+                                "passengerDestLoc": route_leg.destination,
+                                "passengerArrivalTime" : route_leg.arrival,
                                 "passengerStartLoc": trip["start"]["name"],
                                 "passengerDepartureTime": trip["time_of_departure"].strftime("%Y-%m-%dT%H:%M"),  
                             }
@@ -182,6 +248,7 @@ def set_profile_description(request):
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@read_only
 def get_profile(request):
     """
     Gets profile data of a user
@@ -196,11 +263,55 @@ def get_profile(request):
                 "first_name": user.first_name,
                 "last_name": user.last_name,
                 "phone_number": user.phone_no,
-                "profile_description": user.profile_description
+                "profile_description": user.profile_description,
+                "photo": photos.photo_urls(user.photo_hash, request),
             }, status=status.HTTP_200_OK)
     return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def upload_photo(request):
+    """
+    Sets the profile photo of the user who has sent the request from an uploaded "photo" file.
+    Thumbnails of the photo are made and stored straight away (see photos.py), their URLs are sent back by size.
+    """
+
+    upload = request.FILES.get("photo")
+    if upload is None:
+        return Response({"error": "photo is required."}, status=status.HTTP_400_BAD_REQUEST)
+    if upload.size > settings.PHOTO_MAX_UPLOAD_MB * 1024 * 1024:
+        return Response({"error": f"Photo must be at most {settings.PHOTO_MAX_UPLOAD_MB:g} MB."},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        photo_hash = photos.save_photo(request.user, upload.read())
+    except photos.InvalidPhoto as error:
+        return Response({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    invalidate_users([request.user.id])
+
+    return Response({"photo": photos.photo_urls(photo_hash, request)}, status=status.HTTP_200_OK)
+
+
+def photo(request, name):
+    """
+    Serves a photo thumbnail from the photos storage when it is on local disk (a bucket serves them itself).
+    Names are content hashed, so thumbnails are sent with PHOTO_CACHE_CONTROL and their name as the ETag.
+    """
+
+    etag = f'"{name}"'
+    if request.headers.get("If-None-Match") == etag:
+        response = HttpResponseNotModified()
+    else:
+        try:
+            response = FileResponse(storages["photos"].open(name), content_type="image/jpeg")
+        except FileNotFoundError:
+            raise Http404("No such photo.")
+    response["Cache-Control"] = settings.PHOTO_CACHE_CONTROL
+    response["ETag"] = etag
+    return response
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def update_phone(request):
@@ -316,16 +427,7 @@ def remove_trip(request):
         if request.user.status != "available":
             trip = request.user.current_trip
 
-            people = CarpoolUser.objects.filter(current_trip=trip.id)
-
-            ids_list = []
-            for user in people:  # remove trip for all users involved in the trip
-                ids_list.append(user.id)
-                user.status = "available"
-                user.current_trip = None
-                user.save()
-
-            trip.delete()
+            ids_list = end_trips([trip.id], delete=True)  # remove trip for all users involved in the trip
             return Response({"uids": ids_list}, status=status.HTTP_200_OK)
 
     return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -333,67 +435,159 @@ def remove_trip(request):
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@renderer_classes([ORJSONRenderer])
 def get_trips(request):
     """
     Used by passengers to search for trips.
     Takes in passenger locations from request.
-    Checks if passenger is going to or from DCU, and only filters from those specific trips.
-
-    Uses Google Distance API to get route info for each trip after adding passenger to waypoints, using get_route_details.
+    Checks if passenger is going to or from DCU, and only filters from those specific active trips with free seats.
+
+    With TRIP_SEARCH_BATCHED each trip's ETA with the passenger is estimated from one batch of travel times between the
+    passenger and every trip's stops (see insertion.estimate_insertions), only trips that can't be estimated that way
+    get route info from the Google Directions API after adding passenger to waypoints, using get_route_details.
+    Trips needing a detour longer than TRIP_SEARCH_MAX_DETOUR_KM (straight line estimate) are left out before routing.
+    With a campus travel table (see travel_table.py) trips are routed in order of the estimate of their ETA it gives.
+    Trips are routed concurrently, any trips not routed before the search deadline are marked with "etaPending".
     Sends back list of trips in order of the ETA they would have if passenger joined them.
+
+    If "limit" is sent only that many trips are routed and sent back along with a "nextCursor",
+    which can be sent back as "cursor" to get the next trips (see search_top_trips),
+    pages come in order of a lower bound of the ETA and each page is in order of the real ETA.
+
+    Only trips leaving within TRIP_SEARCH_TIME_WINDOW minutes (or "timeWindow" if sent) of the passenger's
+    "time_of_departure" are considered, trips leaving at other times are left out by the database query.
+
+    "maxDuration" (seconds) and "maxDistance" (meters) leave out trips whose route would be longer with the passenger,
+    "orderBy": "duration" sends trips back in order of their duration instead of their ETA.
     """
 
-    dcu_campuses = {
-        "gla": "Dublin City University, Collins Ave Ext, Whitehall, Dublin 9",
-        "pat": "DCU St Patrick's Campus, Drumcondra Road Upper, Drumcondra, Dublin 9, Ireland"
-    }
+    dcu_campuses = DCU_CAMPUSES
 
     if request.method == 'POST':
-        passenger = CarpoolUser.objects.get(id=request.user.id)
+        passenger = request.user
 
         if passenger.status == "busy":
             return Response({"error": "You already have an ongoing trip."})
 
         passenger_start_dcu = request.data["start"]["name"] in dcu_campuses.values()
 
-        active_driver_users = CarpoolUser.objects.exclude(current_trip=None)
-
-        active_trip_id_list = [driver.current_trip.id for driver in active_driver_users if
-                               driver.current_trip.id != None]
-        if passenger_start_dcu:
-            active_trips = Trip.objects.filter(id__in=active_trip_id_list).filter(start__name__in=dcu_campuses.values())
-        else:
-            active_trips = Trip.objects.filter(id__in=active_trip_id_list).filter(
-                destination__name__in=dcu_campuses.values())
-
-        sorted_trips = active_trips.order_by("time_of_departure")
-        final_list = []
-        for trip in sorted_trips:
+        order_by = request.data.get("orderBy", "ETA")
+        try:
+            max_duration, max_distance = (int(request.data[key]) if request.data.get(key) is not None else None
+                                          for key in ("maxDuration", "maxDistance"))
+        except (TypeError, ValueError):
+            return Response({"error": "Invalid maxDuration or maxDistance."}, status=status.HTTP_400_BAD_REQUEST)
+        if order_by not in SEARCH_ORDERS:
+            return Response({"error": "Invalid orderBy."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            departure_time = parse_search_time(request.data.get("time_of_departure"))
+            time_window = float(request.data.get("timeWindow", settings.TRIP_SEARCH_TIME_WINDOW))
+        except (TypeError, ValueError):
+            return Response({"error": "Invalid time_of_departure or timeWindow."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # active trips going the same direction as the passenger with at least one free seat (uses trip_search_idx)
+        active_trips = Trip.objects.filter(is_active=True, to_campus=not passenger_start_dcu,
+                                           campus__in=dcu_campuses.keys(), available_seats__gt=0) \
+            .select_related("driver_id").prefetch_related("trip_passengers", "trip_waypoints")
+        # only trips leaving within the time window of when the passenger wants to leave (uses trip_time_idx)
+        if departure_time is not None and time_window > 0:
+            window = timedelta(minutes=time_window)
+            active_trips = active_trips.filter(time_of_departure__range=(departure_time - window, departure_time + window))
+        # adding the passenger only makes a trip's route longer, so trips already too long are left out here
+        if max_duration is not None:
+            active_trips = active_trips.filter(duration_s__lte=max_duration)
+        if max_distance is not None:
+            active_trips = active_trips.filter(distance_m__lte=max_distance)
+
+        def within_limits(trip):
+            return (max_duration is None or trip.duration_s <= max_duration) and \
+                (max_distance is None or trip.distance_m <= max_distance)
+
+        # candidates are routed in order of their current ETA/duration, so the likely best trips are routed first
+        with read_database():
+            sorted_trips = list(active_trips.order_by(SEARCH_ORDERS[order_by], "id"))
+
+        # rules out trips which would need too long a detour to pick up/drop off the passenger before routing any trips
+        passenger_point = location_point(request.data["destination"] if passenger_start_dcu else request.data["start"])
+        if settings.TRIP_SEARCH_MAX_DETOUR_KM and passenger_point is not None:
+            detours = estimate_detours(sorted_trips, *passenger_point)
+            sorted_trips = [trip for trip, detour in zip(sorted_trips, detours)
+                            if not detour > settings.TRIP_SEARCH_MAX_DETOUR_KM]
+
+        # with a campus travel table, trips are ranked by an estimate of their duration with the passenger without any
+        # routing requests, it isn't a strict lower bound so no trips are left out by it
+        if passenger_point is not None:
+            table_estimates = duration_estimates(sorted_trips, *passenger_point)
+            if not np.isnan(table_estimates).all():
+                def estimate(i):
+                    duration = max(sorted_trips[i].duration_s, np.nan_to_num(table_estimates[i]))
+                    return duration if order_by == "duration" else sorted_trips[i].time_of_departure.timestamp() + duration
+
+                sorted_trips = [sorted_trips[i] for i in sorted(range(len(sorted_trips)),
+                                                                key=lambda i: (estimate(i), sorted_trips[i].pk))]
+
+        estimates = {}
+        if settings.TRIP_SEARCH_BATCHED and sorted_trips and \
+                (passenger_start_dcu or request.data["destination"]["name"] in dcu_campuses.values()):
+            try:
+                estimates = estimate_insertions(
+                    sorted_trips, request.data["destination"] if passenger_start_dcu else request.data["start"]
+                )
+            except (RoutingError, NotImplementedError, requests.RequestException) as error:
+                logger.warning("Batched trip search failed, routing each trip instead: %s", error)
+
+        def route_with_passenger(trip):
+            if trip.pk in estimates:
+                return estimates[trip.pk]
+
+            # routes a copy so trips still being routed after the deadline are never sent back half updated
             if passenger_start_dcu and (trip.start["name"] in dcu_campuses.values()):
-                updated_trip = get_route_details(trip, request.data["destination"]["name"])
+                return get_route_details(copy.copy(trip), request.data["destination"])
 
             elif (request.data["destination"]["name"] in dcu_campuses.values()) \
                     and (trip.destination["name"] in dcu_campuses.values()):
-                updated_trip = get_route_details(trip, request.data["start"]["name"])
-
-            final_list.append(updated_trip)
+                return get_route_details(copy.copy(trip), request.data["start"])
+
+        next_cursor = None
+        if request.data.get("limit") is not None:
+            try:
+                cursor = decode_search_cursor(request.data.get("cursor"))
+                limit = int(request.data["limit"])
+                if limit < 1:
+                    raise ValueError(limit)
+            except (TypeError, ValueError):
+                return Response({"error": "Invalid limit or cursor."}, status=status.HTTP_400_BAD_REQUEST)
+
+            final_sorted_list, pending_list, next_cursor = search_top_trips(
+                sorted_trips, route_with_passenger, passenger_point, limit, cursor, order_by, within_limits
+            )
+        else:
+            routed_trips = map_with_deadline(route_with_passenger, sorted_trips, settings.TRIP_SEARCH_DEADLINE)
 
-        final_sorted_list = sorted(final_list, key=lambda t: t.ETA)
+            final_list = [trip for trip in routed_trips if trip is not None and within_limits(trip)]
+            # trips which could not be routed before the search deadline, these go after all trips with an ETA
+            pending_list = [trip for trip, routed in zip(sorted_trips, routed_trips) if routed is None]
 
-        trips_serialized = json.loads(django_serializers.serialize("json", final_sorted_list))
+            final_sorted_list = sorted(final_list, key=lambda t: (search_order_value(t, order_by), t.pk))
 
-        for index, trip in enumerate(trips_serialized):
-            driver_name = Driver.objects.get(id=trips_serialized[index]["fields"]["driver_id"]).name
+        if settings.TRIP_SEARCH_DROP_PENDING:
+            pending_list = []
 
+        trips_serialized = []
+        for index, trip in enumerate(final_sorted_list + pending_list):
             if not request.data["isPassengerToDCU"]:
-                is_campus_same = request.data["start"]["name"] == trip["fields"]["start"]["name"]
+                is_campus_same = request.data["start"]["name"] == trip.start["name"]
             else:
-                is_campus_same = request.data["destination"]["name"] == trip["fields"]["destination"]["name"]
+                is_campus_same = request.data["destination"]["name"] == trip.destination["name"]
 
-            trips_serialized[index] = {
-                "pk": trip["pk"], "driver_name": driver_name, "isCampusSame": is_campus_same, **trip["fields"]
-            }
+            trips_serialized.append({
+                "pk": trip.pk, "driver_name": trip.driver_id.name, "isCampusSame": is_campus_same, **trip_fields(trip)
+            })
+            if index >= len(final_sorted_list):
+                trips_serialized[index]["etaPending"] = True
 
+        if request.data.get("limit") is not None:
+            return Response({"trips": trips_serialized, "nextCursor": next_cursor}, status=status.HTTP_200_OK)
         return Response(trips_serialized, status=status.HTTP_200_OK)
 
     return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -401,6 +595,7 @@ def get_trips(request):
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
+@read_only
 def join_trip(request): 
     """
     Used by passengers to get trip data when a passengers request to a driver is accepted.
@@ -409,7 +604,7 @@ def join_trip(request):
     if request.method == "GET":
         if Trip.objects.filter(id=request.user.current_trip.id).exists():
             trip = Trip.objects.get(id=request.user.current_trip.id)
-            trip_dict = model_to_dict(trip)
+            trip_dict = trip_to_dict(trip)
             trip_dict["driverPhone"] = trip.driver_id.uid.phone_no
             trip_dict["car"] = model_to_dict(trip.driver_id.car)
             trip_dict["driverName"] = f"{trip.driver_id.uid.first_name} {trip.driver_id.uid.last_name}."
@@ -422,133 +617,294 @@ def join_trip(request):
             """
 
             if request.user.status == "passenger_busy":
-                passenger_info = trip_dict["passengers"][f"passenger{request.user.id}"]
+                route_leg = Route.for_trip(trip).passenger_leg(request.user.id)
                 dcu_campuses = ["Dublin City University, Collins Ave Ext, Whitehall, Dublin 9",
                                 "DCU St Patrick's Campus, Drumcondra Road Upper, Drumcondra, Dublin 9, Ireland"]
+                if route_leg is None:
+                    # the passenger's leg isn't in the route until the route worker has recomputed it
+                    trip_dict["route_pending"] = route_pending(trip.id)
+
                 # If trip is TO DCU
-                if trip_dict["start"]["name"] not in dcu_campuses:
-                    passenger_loc = passenger_info["passengerStart"]
-                    route_info = [r for r in trip_dict["route"]["route"] if r["start"] == passenger_loc][0]
+                elif trip_dict["start"]["name"] not in dcu_campuses:
                     passenger_route = {
                         "passengerDestLoc": trip_dict["destination"]["name"],
                         "passengerArrivalTime": trip_dict["ETA"].strftime("%Y-%m-%dT%H:%M"),
-                        "passengerStartLoc": route_info["start"],
-                        "passengerDepartureTime": datetime.strptime(str(route_info["departure_time"]),
-                                                                    "%H:%M %m/%d/%Y"),
+                        "passengerStartLoc": route_leg.start,
+                        "passengerDepartureTime": route_leg.departure,
                     }
 
                 # If trip is FROM DCU
                 else:
-                    passenger_loc = passenger_info["passengerDestination"]
-                    route_info = [r for r in trip_dict["route"]["route"] if r["destination"] == passenger_loc][0]
                     passenger_route = {
-                        "passengerDestLoc": route_info["destination"],
-                        "passengerArrivalTime": datetime.strptime(str(route_info["arrival_time"]), "%H:%M %m/%d/%Y"),
+                        "passengerDestLoc": route_leg.destination,
+                        "passengerArrivalTime": route_leg.arrival,
                         "passengerStartLoc": trip_dict["start"]["name"],
                         "passengerDepartureTime": trip_dict["time_of_departure"].strftime("%Y-%m-%dT%H:%M"),
                     }
 
+            # URL of the smallest thumbnail of the driver's and each passenger's photo by user id, for the trip screen
+            member_ids = [trip.driver_id.uid_id, *[int(passenger["passengerID"]) for passenger in trip_dict["passengers"].values()]]
+            smallest = str(min(settings.PHOTO_SIZES))
+            trip_dict["photos"] = {}
+            for user_id, photo_hash in CarpoolUser.objects.filter(id__in=member_ids).exclude(photo_hash="") \
+                    .values_list("id", "photo_hash"):
+                trip_dict["photos"][str(user_id)] = photos.photo_urls(photo_hash, request)[smallest]
+
             return Response({"trip_data": trip_dict, "passenger_route": passenger_route}, status=status.HTTP_200_OK)
 
         return Response({"error": "Trip no longer exists."}, status=status.HTTP_404_NOT_FOUND)
     return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
-def get_route_details(trip, passenger_location="", passenger_secondary_location=""):
+TRIP_EVENTS_TICKET_SALT = "carpool.trip_events"
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def trip_events_ticket(request):
     """
-    Used to get route details such as total distance, total duration, ETA, optimal waypoint order of a route.
-    This is used whenever a user requests map data.
+    Gives the user a "ticket" for opening the trip update stream from clients that can't set headers
+    (EventSource in browsers), so their token is never put in a URL where it could be logged.
+    Tickets are signed and only last TRIP_EVENTS_TICKET_TTL seconds.
+    """
+
+    ticket = signing.dumps(request.user.id, salt=TRIP_EVENTS_TICKET_SALT)
+    return Response({"ticket": ticket, "expiresIn": settings.TRIP_EVENTS_TICKET_TTL}, status=status.HTTP_200_OK)
+
+
+async def trip_events(request):
+    """
+    Streams changes to the user's current trip as Server-Sent Events: passengers joining or leaving,
+    new ETAs and the trip ending or being removed (see events.py).
+    Authenticated with the user's token in the Authorization header, or a "ticket" in the query string
+    from trip_events_ticket since EventSource in browsers can't set headers.
+    Streams stay open, so the backend must be served through backend.asgi (e.g. with uvicorn) for this to work.
     """
 
-    if len(trip.waypoints) < 1:
-        waypoints = ""
+    authorization = request.headers.get("Authorization", "").split()
+    if len(authorization) == 2 and authorization[0] == "Token":
+        try:
+            user, token = await sync_to_async(CachedTokenAuthentication().authenticate_credentials)(authorization[1])
+        except AuthenticationFailed:
+            return JsonResponse({"error": "Invalid token."}, status=status.HTTP_401_UNAUTHORIZED)
     else:
-        print(trip.waypoints.values())
-        waypoints = "|".join([wp["name"] for wp in trip.waypoints.values()])
+        try:
+            user_id = signing.loads(request.GET.get("ticket", ""), salt=TRIP_EVENTS_TICKET_SALT,
+                                    max_age=settings.TRIP_EVENTS_TICKET_TTL)
+        except signing.BadSignature:
+            return JsonResponse({"error": "Invalid or expired ticket."}, status=status.HTTP_401_UNAUTHORIZED)
+        user = await CarpoolUser.objects.filter(id=user_id, is_active=True).afirst()
+        if user is None:
+            return JsonResponse({"error": "Invalid or expired ticket."}, status=status.HTTP_401_UNAUTHORIZED)
 
-    directions_base_url = "https://maps.googleapis.com/maps/api/directions/json"
-    directions_url = urllib.parse.quote(
-        f"{directions_base_url}?destination={trip.destination['name']}&origin={trip.start['name']}&waypoints=optimize:true|{waypoints}|{passenger_location}|{passenger_secondary_location}&key={settings.GOOGLE_API_KEY}",
-        safe='=?:/&'
-    )
+    if user.current_trip_id is None:
+        return JsonResponse({"error": "User does not have an active trip."}, status=status.HTTP_400_BAD_REQUEST)
 
+    response = StreamingHttpResponse(stream_trip_events(user.current_trip_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # stops nginx buffering the stream
+    return response
 
-    previous_waypoint_order = {}
-    wp_list = list(trip.waypoints.values())
-    
-    i = 0
-    while i < len(wp_list):
-        """
-        A issue with Google Directions API is that it automatically converts the address names, 
-        here we solve this by preserving the previous waypoint order names and use the new waypoint order to get back 
-        the new waypoint order with preserved names as they were before the API request below.
-        """
-        previous_waypoint_order[i] = wp_list[i]["name"]
-        i += 1
-    
-    if passenger_location != "":
-        previous_waypoint_order[i] = passenger_location
 
-    response = requests.get(directions_url)
+@api_view(["GET"])
+@permission_classes([IsCarpoolAdmin])
+def route_cache_stats(request):
+    """
+    Gets the route cache hit/miss counters for this worker,
+    used to see how many Directions API calls the route cache is saving.
+    """
 
-    waypoint_order = response.json()["routes"][0].get("waypoint_order")
+    return Response(get_route_cache().stats(), status=status.HTTP_200_OK)
 
-    distance_calculation = 0
-    duration_calculation = 0
-    departure_time = datetime.timestamp(trip.time_of_departure)
-    route = []
-    # Gets the distance and duration between each waypoint in the trip.
-    # Also gets the departure time and arrival time to destination/from start.
-    # This data is used by frontend to display personalised ETA / Departure times to each passenger in trip.
-    for leg in response.json()["routes"][0]["legs"]:
-        arrival_time = departure_time + int(leg["duration"]["value"])
-        waypoint_info = {
-            "start": leg["start_address"],
-            "destination": leg["end_address"],
-            "distance": leg["distance"]["text"],
-            "duration": leg["duration"]["text"],
-            "departure_time": datetime.fromtimestamp(departure_time).replace(microsecond=0).strftime("%H:%M %m/%d/%Y"),
-            "arrival_time": datetime.fromtimestamp(arrival_time).replace(microsecond=0).strftime("%H:%M %m/%d/%Y")
-        }
-
-        if "km" in leg["distance"]["text"]:
-            distance_calculation += float(leg["distance"]["text"].replace(",", "")[:-3])
-        else:
-            distance_calculation += float(leg["distance"]["text"][:-2]) // 1000
 
-        duration_calculation += int(leg["duration"]["value"])
+@api_view(["GET"])
+@permission_classes([IsCarpoolAdmin])
+def metrics(request):
+    """
+    Gets this worker's metrics in the Prometheus text format (see metrics.py),
+    the trip and seat gauges are counted from the database on each scrape.
+    Prometheus authenticates with an admin's token: authorization: {type: Token, credentials: <token>}
+    """
+
+    trips = Trip.objects.filter(is_active=True).aggregate(trips=Count("id"), seats=Sum("available_seats"))
+    carpool_metrics.active_trips.set(trips["trips"])
+    carpool_metrics.available_seats.set(trips["seats"] or 0)
+    carpool_metrics.active_passengers.set(TripPassenger.objects.filter(trip__is_active=True).count())
+
+    return HttpResponse(carpool_metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# trip column each search order sorts by
+SEARCH_ORDERS = {"ETA": "ETA", "duration": "duration_s"}
+
+
+def parse_search_time(value):
+    """
+    :return: aware datetime of a search's time_of_departure, or None if it wasn't sent
+    """
+
+    if not value:
+        return None
+    departure_time = parse_datetime(str(value))
+    if departure_time is None:
+        raise ValueError(f"Invalid datetime {value!r}")
+    return departure_time if timezone.is_aware(departure_time) else timezone.make_aware(departure_time)
+
+
+def search_order_value(trip, order_by):
+    """
+    :return: the value trips are sorted by in a search, the ETA timestamp or the duration in seconds
+    """
+
+    return trip.duration_s if order_by == "duration" else int(trip.ETA.timestamp())
+
+
+def encode_search_cursor(value, pk):
+    return base64.urlsafe_b64encode(json.dumps([int(value), pk]).encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    """
+    :return: (lower bound, trip id) of the last trip looked at by the previous page, or None for the first page
+    """
+
+    if not cursor:
+        return None
+    bound, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    return int(bound), int(pk)
+
+
+def search_top_trips(trips, route_with_passenger, passenger_point, limit, cursor=None, order_by="ETA", keep=None):
+    """
+    Gets the next page of limit trips after the cursor, only routing the trips on that page.
+
+    Trips are paged in order of a lower bound of their ETA, their departure time plus the straight line distance
+    from their start to the passenger to their destination at TRIP_SEARCH_MAX_SPEED_KPH
+    (or of their duration, the longer of that travel time and their duration before adding the passenger),
+    which doesn't need any routing. A page routes the trips after the cursor in that order, in batches of up to
+    ROUTING_MAX_WORKERS so the routing thread pool is still used, until it has limit trips, and sends them back in
+    order of their real ETA. Routed trips for which keep returns False are dropped and don't count towards the limit.
+    Once TRIP_SEARCH_DEADLINE has passed no more trips are routed and the page ends early,
+    the next page carries on from the last trip looked at.
+
+    :return: (routed trips in order of ETA, trips not routed before the deadline, cursor for the next page or None)
+    """
+
+    if passenger_point is not None:
+        distances = np.nan_to_num(via_distances(trips, *passenger_point))
+    else:
+        distances = np.zeros(len(trips))
+    max_speed = settings.TRIP_SEARCH_MAX_SPEED_KPH / 3600
+    durations = distances / max_speed
+
+    # (lower bound of the ETA timestamp or duration, trip id, trip)
+    if order_by == "duration":
+        candidates = [(int(max(duration, trip.duration_s)), trip.pk, trip)
+                      for trip, duration in zip(trips, durations.tolist())]
+    else:
+        candidates = [(int(trip.time_of_departure.timestamp() + duration), trip.pk, trip)
+                      for trip, duration in zip(trips, durations.tolist())]
+    candidates.sort(key=lambda candidate: candidate[:2])
+    if cursor is not None:
+        candidates = [candidate for candidate in candidates if candidate[:2] > cursor]
+
+    deadline = time.monotonic() + settings.TRIP_SEARCH_DEADLINE
+    found = []
+    pending = []
+    position = 0
+    while position < len(candidates) and len(found) + len(pending) < limit and time.monotonic() < deadline:
+        batch = [trip for bound, pk, trip in
+                 candidates[position:position + min(settings.ROUTING_MAX_WORKERS, limit - len(found) - len(pending))]]
+        position += len(batch)
+
+        for trip, routed in zip(batch, map_with_deadline(route_with_passenger, batch, deadline - time.monotonic())):
+            if routed is None:
+                pending.append(trip)
+            elif keep is None or keep(routed):
+                found.append(routed)
+
+    next_cursor = None
+    if position < len(candidates):
+        # with nothing looked at before the deadline, the next page starts where this one did
+        next_cursor = encode_search_cursor(*(candidates[position - 1][:2] if position else cursor or (-1, 0)))
+
+    found.sort(key=lambda trip: (search_order_value(trip, order_by), trip.pk))
+    return found, pending, next_cursor
+
+
+def get_route_details(trip, passenger_location=None, passenger_secondary_location=None):
+    """
+    Used to get route details such as total distance, total duration, ETA, optimal waypoint order of a route.
+    This is used whenever a user requests map data.
+    Passenger locations are location dicts (name, lat, lng) of stops to add to the trip waypoints.
+    """
+
+    waypoints = list(trip.waypoints.values())
+    waypoints += [location for location in (passenger_location, passenger_secondary_location) if location]
 
-        departure_time += int(leg["duration"]["value"])
+    directions = get_directions(trip.start, trip.destination, waypoints, trip.time_of_departure)
 
-        # shows distance & duration between waypoints
-        route.append(waypoint_info)
+    departure_time = int(trip.time_of_departure.timestamp())
+    route = Route()
+    # Gets the distance and duration between each waypoint in the trip.
+    # Also gets the departure time and arrival time to destination/from start.
+    # This data is used by frontend to display personalised ETA / Departure times to each passenger in trip.
+    for leg in directions["legs"]:
+        duration = int(leg["duration"]["value"])
+        route.legs.append(RouteLeg(
+            leg["start_address"], leg["end_address"], int(leg["distance"]["value"]), duration,
+            departure_time, departure_time + duration
+        ))
+        departure_time += duration
 
     # gets the order of the waypoints based on response from Directions API.
-    route[0]["start"] = trip.start["name"]
+    # Directions API converts the address names, so the names as they were before the request are used instead.
+    ordered_waypoints = [waypoint["name"] for waypoint in directions["ordered_waypoints"]]
+    route.legs[0].start = trip.start["name"]
     i = 0
-    while i < len(route) - 1:
-        route[i]["destination"] = previous_waypoint_order[waypoint_order[i]]
-        route[i + 1]["start"] = previous_waypoint_order[waypoint_order[i]]
+    while i < len(route.legs) - 1:
+        route.legs[i].destination = ordered_waypoints[i]
+        route.legs[i + 1].start = ordered_waypoints[i]
         i += 1
 
-    route[-1]["destination"] = trip.destination["name"]
+    route.legs[-1].destination = trip.destination["name"]
+    route.index_passengers(trip)
 
-    trip_time = timedelta(seconds=duration_calculation)
-    eta = trip.time_of_departure + trip_time
+    trip.distance_m = sum(leg.distance for leg in route.legs)
+    trip.duration_s = sum(leg.duration for leg in route.legs)
+    eta = trip.time_of_departure + timedelta(seconds=trip.duration_s)
 
-    duration_calculation = str(timedelta(seconds=duration_calculation)).split(":")
-    total_duration = f"{duration_calculation[0]} hours, {duration_calculation[1].lstrip('0')} min, {duration_calculation[2]} sec"
+    trip.distance = format_trip_distance(trip.distance_m)
+    trip.duration = format_trip_duration(trip.duration_s)
+    trip.ETA = eta.replace(microsecond=0)
+    trip.route = route.to_json()
 
-    # removes .0 from distance
-    if str(distance_calculation)[-1] == "0":
-        total_distance = str(distance_calculation)[:-2] + " km"
-    else:
-        total_distance = str(round(distance_calculation, 1)) + " km"
+    return trip
 
-    trip.distance = total_distance
-    trip.duration = total_duration
-    trip.ETA = eta.replace(microsecond=0)
-    trip.route = {"route": route}
+
+def update_trip_route(trip_id, attempts=3):
+    """
+    Recomputes a trip's route after its passengers change, outside of any transaction.
+    The route is only saved if the trip version hasn't changed while it was being computed,
+    otherwise it is recomputed with the new passengers, up to attempts times.
+
+    :return: the trip with its new route, or None if the trip no longer exists
+    """
+
+    trip = None
+    for attempt in range(attempts):
+        trip = Trip.objects.filter(id=trip_id).first()
+        if trip is None:
+            return None
+
+        get_route_details(trip)
+        saved = Trip.objects.filter(id=trip_id, version=trip.version) \
+            .update(route=trip.route, ETA=trip.ETA, distance=trip.distance, duration=trip.duration,
+                    distance_m=trip.distance_m, duration_s=trip.duration_s)
+        if saved:
+            publish_trip_event(trip_id, "eta", ETA=trip.ETA, distance=trip.distance, duration=trip.duration,
+                               route=route_to_wire(trip.route))
+            break
 
     return trip
 
@@ -559,14 +915,10 @@ def add_passenger_to_trip(request):
     """
     Request sent by Driver to add passenger to a trip if they have no ongoing trips.
     Updates driver trip data such as waypoints, passengers, available_seats.
-    Also calls get_route_details to get new ETA/departure times for all other passengers and driver.
+    Also calls get_route_details to get new ETA/departure times for all other passengers and driver,
+    or queues it for the route worker if ROUTE_QUEUE_ENABLED is set.
     """
 
-    dcu_campuses = {
-        "gla": "Dublin City University, Collins Ave Ext, Whitehall, Dublin 9",
-        "pat": "DCU St Patrick's Campus, Drumcondra Road Upper, Drumcondra, Dublin 9, Ireland"
-    }
-
     if request.method == "POST":
         passenger_start = request.data["passengerData"]["passengerStart"]
         passenger_dest = request.data["passengerData"]["passengerDestination"]
@@ -575,46 +927,18 @@ def add_passenger_to_trip(request):
             passenger_user = CarpoolUser.objects.get(id=request.data["passengerData"]["id"])
             if Trip.objects.filter(id=trip_id).exists():
                 trip = Trip.objects.get(id=trip_id)
-                if trip.passengers.get(f"passenger{passenger_user.id}") is None:
-                    passenger_user.current_trip = trip  
-                    passenger_user.status = "passenger_busy" 
-                else:
-                    return Response({"error": "passenger already in the same trip."}, status=status.HTTP_400_BAD_REQUEST)
-
-                trip.passengers[f"passenger{passenger_user.id}"] = {
-                    "passengerName": f"{passenger_user.first_name} {passenger_user.last_name[0]}.",
-                    "passengerID": request.data["passengerData"]["id"],
-                    "passengerStart": passenger_start["name"],
-                    "passengerDestination": passenger_dest["name"],
-                }
-
-                same_campus = (trip.start["name"] == passenger_start["name"]) or \
-                              (trip.destination["name"] == passenger_dest["name"])
-
-                if (trip.start["name"] in dcu_campuses.values()) and (passenger_start["name"] in dcu_campuses.values()): 
-                    trip.waypoints[f"waypoint{len(trip.waypoints) + 1}"] = { 
-                        "name": passenger_dest["name"],
-                        "passenger": f"{passenger_user.first_name} {passenger_user.last_name[0]}.",
-                        "lat": passenger_dest["lat"],
-                        "lng": passenger_dest["lng"],
-                    }
-                    trip.passengers[f"passenger{passenger_user.id}"]["passengerStart"] = trip.start["name"]
-
-                elif (trip.destination["name"] in dcu_campuses.values()) and (passenger_dest["name"] in dcu_campuses.values()):
-                    trip.waypoints[f"waypoint{len(trip.waypoints)+1}"] = {
-                        "name": passenger_start["name"],
-                        "passenger": f"{passenger_user.first_name} {passenger_user.last_name[0]}.",
-                        "lat": passenger_start["lat"],
-                        "lng": passenger_start["lng"],
-                    }
-                    trip.passengers[f"passenger{passenger_user.id}"]["passengerDestination"] = trip.destination["name"]
+                membership, waypoint, same_campus = trip_membership(trip, passenger_user, passenger_start, passenger_dest)
 
-                trip.available_seats -= 1
-                route_details = get_route_details(trip)
-                trip_data = model_to_dict(route_details)
+                try:
+                    add_passenger(trip.id, membership, waypoint)
+                except AlreadyInTrip:
+                    return Response({"error": "passenger already in the same trip."}, status=status.HTTP_400_BAD_REQUEST)
+                except TripFull:
+                    return Response({"error": "No seats available."}, status=status.HTTP_400_BAD_REQUEST)
 
-                passenger_user.save()
-                route_details.save()
+                trip_data = reroute_trip(trip.id)
+                if trip_data is None:
+                    return Response({"error": "Trip no longer exists."}, status=status.HTTP_404_NOT_FOUND)
                 return Response({"trip_data": trip_data, "is_same_campus": same_campus}, status=status.HTTP_200_OK)
 
             return Response({"error": "Trip no longer exists."}, status=status.HTTP_404_NOT_FOUND)
@@ -622,6 +946,62 @@ def add_passenger_to_trip(request):
     return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+def trip_membership(trip, passenger_user, passenger_start, passenger_dest):
+    """
+    Builds the (unsaved) TripPassenger for a passenger joining a trip, along with the TripWaypoint of the stop
+    the trip makes for them (None if the trip doesn't need one).
+
+    :return: (membership, waypoint, whether the passenger goes to or from the same place as the trip)
+    """
+
+    dcu_campuses = DCU_CAMPUSES
+
+    passenger_name = f"{passenger_user.first_name} {passenger_user.last_name[0]}."
+    membership = TripPassenger(trip=trip, user=passenger_user, name=passenger_name,
+                               start=passenger_start["name"], destination=passenger_dest["name"])
+    waypoint = None
+
+    same_campus = (trip.start["name"] == passenger_start["name"]) or \
+                  (trip.destination["name"] == passenger_dest["name"])
+
+    if (trip.start["name"] in dcu_campuses.values()) and (passenger_start["name"] in dcu_campuses.values()):
+        waypoint = passenger_dest
+        membership.start = trip.start["name"]
+
+    elif (trip.destination["name"] in dcu_campuses.values()) and (passenger_dest["name"] in dcu_campuses.values()):
+        waypoint = passenger_start
+        membership.destination = trip.destination["name"]
+
+    if waypoint is not None:
+        waypoint = TripWaypoint(trip=trip, passenger=passenger_user, name=waypoint["name"],
+                                passenger_name=passenger_name, lat=waypoint["lat"], lng=waypoint["lng"])
+
+    return membership, waypoint, same_campus
+
+
+def reroute_trip(trip_id):
+    """
+    Recomputes a trip's route after a passenger joins, or queues it for the route worker if ROUTE_QUEUE_ENABLED is set.
+
+    :return: the trip as a dict for the app (with "route_pending" if the route is queued), or None if the trip no longer exists
+    """
+
+    if settings.ROUTE_QUEUE_ENABLED:
+        # sent back straight away with the old route, the route worker fills in the new one
+        enqueue_route(trip_id)
+        trip = Trip.objects.filter(id=trip_id).first()
+    else:
+        # the route is recomputed after the seat is reserved, so no locks are held during the Directions call
+        trip = update_trip_route(trip_id)
+    if trip is None:
+        return None
+
+    trip_data = trip_to_dict(trip)
+    if settings.ROUTE_QUEUE_ENABLED:
+        trip_data["route_pending"] = True
+    return trip_data
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def end_trip(request):
@@ -631,15 +1011,7 @@ def end_trip(request):
     if request.method == "POST":
         trip_id = request.data.get("tripID")
         if Trip.objects.filter(id=trip_id).exists():
-            people = CarpoolUser.objects.filter(current_trip=trip_id)
-
-            ids_list = []
-            for user in people:  # removes any passengers involved in the trip
-                ids_list.append(user.id)
-                user.status = "available"
-                user.current_trip = None
-                user.save()
-
+            ids_list = end_trips([trip_id])  # removes any passengers involved in the trip
             return Response({"uids": ids_list}, status=status.HTTP_200_OK)
         else:
             return Response({"error": "Trip does not exist."}, status=status.HTTP_404_NOT_FOUND)
@@ -647,61 +1019,186 @@ def end_trip(request):
     return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["POST"])
+@permission_classes([IsCarpoolAdmin])
+def end_trips_bulk(request):
+    """
+    Used by admins to end many trips at once, e.g. after a campus event.
+    Takes a list of "tripIDs", or "campus" (key of DCU_CAMPUSES) to end every active trip to or from that campus.
+    It returns the number of trips ended and the user ids of everyone who was in them, for removing from Firebase.
+    """
+
+    trip_ids = request.data.get("tripIDs")
+    campus = request.data.get("campus")
+    if trip_ids is None and campus is None:
+        return Response({"error": "tripIDs or campus is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    trips = Trip.objects.filter(is_active=True)
+    if trip_ids is not None:
+        if not isinstance(trip_ids, list) or \
+                not all(isinstance(trip_id, int) and not isinstance(trip_id, bool) for trip_id in trip_ids):
+            return Response({"error": "tripIDs must be a list of trip ids."}, status=status.HTTP_400_BAD_REQUEST)
+        trips = trips.filter(id__in=trip_ids)
+    if campus is not None:
+        if campus not in DCU_CAMPUSES:
+            return Response({"error": "Unknown campus."}, status=status.HTTP_400_BAD_REQUEST)
+        trips = trips.filter(campus=campus)
+
+    ended = list(trips.values_list("id", flat=True))
+    ids_list = end_trips(ended)
+    return Response({"ended": len(ended), "uids": ids_list}, status=status.HTTP_200_OK)
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def passenger_leave_trip(request):
     """
     Used by passengers to leave trip if they are in one.
     Updates driver trip data such as waypoints, passengers, available_seats.
-    Also calls get_route_details to get new ETA/departure times for all other passengers and driver.
+    Also calls get_route_details to get new ETA/departure times for all other passengers and driver,
+    or queues it for the route worker if ROUTE_QUEUE_ENABLED is set.
     """
 
     if request.method == "GET":
         passenger = request.user
         if passenger.current_trip is not None:
-            trip = passenger.current_trip
+            trip_id = passenger.current_trip_id
+            remove_passenger(trip_id, passenger.id)
+            if settings.ROUTE_QUEUE_ENABLED:
+                enqueue_route(trip_id)
+                trip = Trip.objects.filter(id=trip_id).first()
+                if trip is None:
+                    return Response({"error": "Trip no longer exists."}, status=status.HTTP_404_NOT_FOUND)
+                return Response({"status": "Passenger removed from trip.", "available_seats": trip.available_seats,
+                                 "route_pending": True}, status=status.HTTP_200_OK)
+
+            trip = update_trip_route(trip_id)
+            if trip is None:
+                # the driver ended the trip while the passenger was leaving it
+                return Response({"error": "Trip no longer exists."}, status=status.HTTP_404_NOT_FOUND)
+            return Response({"status": "Passenger removed from trip.", "available_seats": trip.available_seats}, status=status.HTTP_200_OK)
+        else:
+            return Response({"error": "Passenger does not have an active trip."}, status=status.HTTP_400_BAD_REQUEST)
 
-            temp_passengers_dict = {**trip.passengers}
-            locations_count = {}
+    return Response(status=status.HTTP_400_BAD_REQUEST)
 
-            for key, passenger in trip.passengers.items():
-                # prevents removing leaving passengers waypoints if other passengers have it as well
-                if passenger["passengerStart"] not in locations_count:
-                    locations_count[passenger["passengerStart"]] = 1
-                else:
-                    locations_count[passenger["passengerStart"]] += 1
 
-                if passenger["passengerDestination"] not in locations_count:
-                    locations_count[passenger["passengerDestination"]] = 1
-                else:
-                    locations_count[passenger["passengerDestination"]] += 1
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def request_ride(request):
+    """
+    Used by passengers to ask to be matched to a trip instead of searching for one,
+    takes "start", "destination" and "time_of_departure". A passenger has at most one open request,
+    asking again replaces it. Requests are matched in batches by the match_requests command (see matching.py).
+    """
 
-                temp_waypoints_dict = {**trip.waypoints}
-                if int(passenger["passengerID"]) == request.user.id:
-                    temp_passengers_dict.pop(key)
-                    passenger_start = passenger["passengerStart"]
-                    passenger_destination = passenger["passengerDestination"]
-                    for waypoint_key, waypoint in trip.waypoints.items():
-                        if waypoint["name"] == passenger_start or waypoint["name"] == passenger_destination:
-                            if locations_count[waypoint["name"]] == 1:
-                                temp_waypoints_dict.pop(waypoint_key)
-                                locations_count[waypoint["name"]] = 0
+    passenger = request.user
+    if passenger.current_trip_id is not None:
+        return Response({"error": "You already have an ongoing trip."}, status=status.HTTP_400_BAD_REQUEST)
 
-                    trip.waypoints = temp_waypoints_dict
+    start, destination = request.data.get("start"), request.data.get("destination")
+    if not isinstance(start, dict) or not isinstance(destination, dict):
+        return Response({"error": "start and destination are required."}, status=status.HTTP_400_BAD_REQUEST)
 
-            passenger = request.user
+    try:
+        time_of_departure = parse_search_time(request.data.get("time_of_departure")) or timezone.now()
+    except (TypeError, ValueError):
+        return Response({"error": "Invalid time_of_departure."}, status=status.HTTP_400_BAD_REQUEST)
+    if not journey_campus(start, destination)[1]:
+        return Response({"error": "Trips must start or end at a DCU campus."}, status=status.HTTP_400_BAD_REQUEST)
 
-            trip.passengers = temp_passengers_dict
-            trip.available_seats += 1
+    ride_request = RideRequest(passenger=passenger, start=start, destination=destination,
+                               time_of_departure=time_of_departure)
 
-            route_details = get_route_details(trip)
-            route_details.save()
+    with transaction.atomic():
+        RideRequest.objects.filter(passenger=passenger, status__in=("open", "proposed")).update(status="cancelled")
+        ride_request.save()
+    return Response({"requestID": ride_request.id, "status": ride_request.status}, status=status.HTTP_201_CREATED)
 
-            passenger.current_trip = None
-            passenger.status = "available"
-            passenger.save()
-            return Response({"status": "Passenger removed from trip.", "available_seats": trip.available_seats}, status=status.HTTP_200_OK)
-        else:
-            return Response({"error": "Passenger does not have an active trip."}, status=status.HTTP_400_BAD_REQUEST)
 
-    return Response(status=status.HTTP_400_BAD_REQUEST)
+def is_trip_driver(user):
+    """
+    :return: whether the user is driving their current trip, passengers on it have the same current trip
+    """
+
+    return user.current_trip_id is not None and \
+        Trip.objects.filter(id=user.current_trip_id, driver_id__uid=user).exists()
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+@read_only
+def match_proposals(request):
+    """
+    Used by drivers to get the ride requests proposed for their current trip by batch matching.
+    """
+
+    if not is_trip_driver(request.user):
+        return Response({"error": "Only the driver of a trip can see its proposals."}, status=status.HTTP_403_FORBIDDEN)
+
+    proposals = RideRequest.objects.filter(status="proposed", proposed_trip_id=request.user.current_trip_id,
+                                           proposed_trip__driver_id__uid=request.user) \
+        .select_related("passenger").order_by("proposed_at", "id")
+    return Response({"proposals": [proposal.to_json() for proposal in proposals]}, status=status.HTTP_200_OK)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def confirm_match(request):
+    """
+    Used by drivers to confirm (or, with "accept": false, decline) a ride request proposed for their trip.
+    Confirming adds the passenger to the trip the same way as add_passenger_to_trip,
+    declining puts the request back to be matched to another trip.
+    """
+
+    if not is_trip_driver(request.user):
+        return Response({"error": "Only the driver of a trip can answer its proposals."}, status=status.HTTP_403_FORBIDDEN)
+
+    driver_trip_id = request.user.current_trip_id
+    ride_request = RideRequest.objects.filter(id=request.data.get("requestID"), status="proposed",
+                                              proposed_trip_id=driver_trip_id, proposed_trip__driver_id__uid=request.user) \
+        .select_related("passenger", "proposed_trip").first()
+    if ride_request is None:
+        return Response({"error": "Proposal no longer exists."}, status=status.HTTP_404_NOT_FOUND)
+
+    # "accept" may be sent form encoded, so "false" has to be read as a boolean rather than a truthy string
+    try:
+        accept = serializers.BooleanField().to_internal_value(request.data.get("accept", True))
+    except serializers.ValidationError:
+        return Response({"error": "Invalid accept."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if not accept:
+        ride_request.declined_trips.append(driver_trip_id)
+        reopen_request(ride_request)
+        return Response({"status": "Proposal declined."}, status=status.HTTP_200_OK)
+
+    passenger_user = ride_request.passenger
+    if passenger_user.current_trip_id is not None:
+        ride_request.status = "cancelled"
+        ride_request.save(update_fields=["status"])
+        return Response({"error": "Passenger already has a trip."}, status=status.HTTP_400_BAD_REQUEST)
+
+    trip = ride_request.proposed_trip
+    membership, waypoint, same_campus = trip_membership(trip, passenger_user, ride_request.start, ride_request.destination)
+    try:
+        add_passenger(trip.id, membership, waypoint)
+    except (AlreadyInTrip, TripFull) as error:
+        reopen_request(ride_request)
+        message = "No seats available." if isinstance(error, TripFull) else "passenger already in the same trip."
+        return Response({"error": message}, status=status.HTTP_400_BAD_REQUEST)
+
+    ride_request.status = "confirmed"
+    ride_request.save(update_fields=["status"])
+
+    trip_data = reroute_trip(trip.id)
+    if trip_data is None:
+        return Response({"error": "Trip no longer exists."}, status=status.HTTP_404_NOT_FOUND)
+    return Response({"trip_data": trip_data, "is_same_campus": same_campus}, status=status.HTTP_200_OK)
+
+
+def reopen_request(ride_request):
+    ride_request.status = "open"
+    ride_request.proposed_trip = None
+    ride_request.proposed_at = None
+    ride_request.detour_km = None
+    ride_request.save(update_fields=["status", "proposed_trip", "proposed_at", "detour_km", "declined_trips"])